@@ -0,0 +1,239 @@
+"""
+Wall time, peak RSS and throughput of the scoring and classification hot paths on synthetic cohorts.
+Expressions use gene names of databases/signatures.gmt and databases/progeny_coefficients.tsv padded with
+synthetic names. Every case runs in a forked process, so peak RSS is measured per case.
+
+    python benchmarks/hot_paths.py --output baseline.json
+    python benchmarks/hot_paths.py --full --output full.json
+    python benchmarks/hot_paths.py --benchmarks ssgsea_formula --samples 1000 --genes 20000 --compare baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent.parent
+# The repository is not installed: lme and benchmarks are imported from its root
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.neighbors_backend import load_reference, resample  # noqa: E402
+from lme.aliases import GeneAliasIndex  # noqa: E402
+from lme.classification import KNeighborsClusterClassifier  # noqa: E402
+from lme.pathway_scoring import PROGENY_COEFFICIENTS, run_progeny  # noqa: E402
+from lme.utils import read_dataset, read_gene_sets, ssgsea_formula, update_gene_names  # noqa: E402
+
+GENE_SIGNATURES = ROOT.joinpath('databases', 'signatures.gmt')
+
+QUICK_SAMPLES = [10, 100, 1000, 10000]
+QUICK_GENES = [1000, 20000]
+FULL_SAMPLES = [10, 100, 1000, 10000, 100000]
+FULL_GENES = [1000, 20000, 60000]
+
+
+def real_gene_names():
+    """
+    Genes of the signatures and PROGENy coefficients, in file order without duplicates
+    """
+    genes = [gene for gene_set in read_gene_sets(GENE_SIGNATURES).values() for gene in gene_set.genes]
+    genes += list(read_dataset(PROGENY_COEFFICIENTS, index_col=None).hugo_symbol)
+    return list(dict.fromkeys(genes))
+
+
+def gene_names(n_genes):
+    """
+    :param n_genes: int
+    :return: list of n_genes names, real genes first
+    """
+    genes = real_gene_names()[:n_genes]
+    return genes + [f'SYNTH{i}' for i in range(n_genes - len(genes))]
+
+
+def synthetic_expression(n_samples, n_genes, rng):
+    """
+    log2(1 + TPM)-like expressions
+    :return: pd.DataFrame, rows - samples, columns - genes
+    """
+    values = np.log2(1 + rng.gamma(0.5, 20, (n_samples, n_genes)))
+    return pd.DataFrame(values, index=[f'sample_{i}' for i in range(n_samples)], columns=gene_names(n_genes))
+
+
+def synthetic_aliases(genes, fraction, rng):
+    """
+    Rename a fraction of genes to made up previous symbols and build the matching alias index
+    :return: (list of old gene names, GeneAliasIndex)
+    """
+    renamed = set(rng.choice(len(genes), int(fraction * len(genes)), replace=False))
+    old_genes, related = [], {}
+    for i, gene in enumerate(genes):
+        if i in renamed:
+            names = frozenset([gene, f'{gene}_PREV'])
+            related[gene] = related[f'{gene}_PREV'] = names
+            old_genes.append(f'{gene}_PREV')
+        else:
+            old_genes.append(gene)
+    return old_genes, GeneAliasIndex(related)
+
+
+def setup_ssgsea_formula(n_samples, n_genes, rng):
+    data = synthetic_expression(n_samples, n_genes, rng)
+    gene_sets = read_gene_sets(GENE_SIGNATURES)
+    return lambda: ssgsea_formula(data, gene_sets)
+
+
+def setup_run_progeny(n_samples, n_genes, rng):
+    data = synthetic_expression(n_samples, n_genes, rng)
+    prog_coeffs = read_dataset(PROGENY_COEFFICIENTS, index_col=None)
+    # A new scorer for every call: gene name matching and the coefficient pivot are measured on each repeat
+    return lambda: run_progeny(data, prog_coeffs=prog_coeffs)
+
+
+def setup_run_progeny_cached(n_samples, n_genes, rng):
+    data = synthetic_expression(n_samples, n_genes, rng)
+    return lambda: run_progeny(data)
+
+
+def setup_update_gene_names(n_samples, n_genes, rng):
+    genes = gene_names(n_genes)
+    old_genes, alias_index = synthetic_aliases(genes, 0.2, rng)
+    return lambda: update_gene_names(old_genes, genes, alias_index=alias_index)
+
+
+def setup_classifier_fit(n_samples, n_genes, rng):
+    X, y = resample(*load_reference(), n_samples, 0.3, rng)
+    return lambda: KNeighborsClusterClassifier(norm=False, clip=3, k=min(35, n_samples)).fit(X, y)
+
+
+def setup_classifier_predict(n_samples, n_genes, rng):
+    model = KNeighborsClusterClassifier(norm=False, clip=3).fit(*load_reference())
+    X, _ = resample(*load_reference(), n_samples, 0.3, rng)
+    return lambda: model.predict(X)
+
+
+# name -> (setup function, scales over samples, scales over genes)
+BENCHMARKS = {
+    'ssgsea_formula': (setup_ssgsea_formula, True, True),
+    'run_progeny': (setup_run_progeny, True, True),
+    'run_progeny_cached': (setup_run_progeny_cached, True, True),
+    'update_gene_names': (setup_update_gene_names, False, True),
+    'classifier_fit': (setup_classifier_fit, True, False),
+    'classifier_predict': (setup_classifier_predict, True, False),
+}
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(setup, n_samples, n_genes, repeat, connection):
+    warnings.simplefilter('ignore')
+    rng = np.random.default_rng(42)
+    func = setup(n_samples, n_genes, rng)
+    baseline = peak_rss_mb()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    peak = peak_rss_mb()
+    connection.send({'seconds': min(seconds), 'mean_seconds': float(np.mean(seconds)), 'peak_rss_mb': peak,
+                     'rss_increase_mb': peak - baseline})
+
+
+def run_case(setup, n_samples, n_genes, repeat):
+    """
+    Run a benchmark case in a forked process
+    :return: dict of measurements
+    """
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=measure, args=(setup, n_samples, n_genes, repeat, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': f'exit code {process.exitcode}'}
+    process.join()
+    return result
+
+
+def cases(names, samples, genes, max_cells):
+    for name in names:
+        _, over_samples, over_genes = BENCHMARKS[name]
+        for n_samples in (samples if over_samples else [None]):
+            for n_genes in (genes if over_genes else [None]):
+                if n_samples is not None and n_genes is not None and n_samples * n_genes > max_cells:
+                    continue
+                yield name, n_samples, n_genes
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """
+    :return: pd.DataFrame, seconds of the baseline run and the speedup for common cases
+    """
+    with open(baseline_path) as handle:
+        baseline = pd.DataFrame(json.load(handle)['results'])
+    keys = ['benchmark', 'samples', 'genes']
+    current = pd.DataFrame(results)
+    # None (the benchmark does not scale over the dimension) is read as NaN, NaN keys are matched by merge
+    current[keys[1:]] = current[keys[1:]].astype(float)
+    baseline[keys[1:]] = baseline[keys[1:]].astype(float)
+    merged = current.merge(baseline[keys + ['seconds']], on=keys, suffixes=('', '_baseline'))
+    merged['speedup'] = merged.seconds_baseline / merged.seconds
+    return merged[keys + ['seconds_baseline', 'seconds', 'speedup']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument('--samples', type=int, nargs='+')
+    parser.add_argument('--genes', type=int, nargs='+')
+    parser.add_argument('--full', action='store_true', help=f'samples {FULL_SAMPLES}, genes {FULL_GENES}')
+    parser.add_argument('--max-cells', type=float, default=2e8, help='skip larger samples x genes matrices')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='JSON written by a previous run')
+    args = parser.parse_args()
+
+    samples = args.samples or (FULL_SAMPLES if args.full else QUICK_SAMPLES)
+    genes = args.genes or (FULL_GENES if args.full else QUICK_GENES)
+
+    results = []
+    for name, n_samples, n_genes in cases(args.benchmarks, samples, genes, args.max_cells):
+        result = {'benchmark': name, 'samples': n_samples, 'genes': n_genes,
+                  **run_case(BENCHMARKS[name][0], n_samples, n_genes, args.repeat)}
+        if 'seconds' in result:
+            units = n_samples if n_samples is not None else n_genes
+            result['throughput'] = units / result['seconds']
+            result['throughput_unit'] = 'samples/s' if n_samples is not None else 'genes/s'
+        results.append(result)
+        print(pd.DataFrame([result]).to_string(index=False, header=len(results) == 1), flush=True)
+
+    if args.compare:
+        print(compare(results, args.compare).to_string(index=False))
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+                       'pandas': pd.__version__, 'platform': platform.platform(),
+                       'cpu_count': multiprocessing.cpu_count(), 'results': results}, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Label agreement of approximate neighbor backends with the exact sklearn search versus query latency.
+The reference cohort is enlarged by resampling pan-cohort DLBCL samples with gaussian noise.
+
+    python benchmarks/neighbors_backend.py --reference-size 200000 --queries 2000
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent.parent
+# The repository is not installed: lme is imported from its root
+sys.path.insert(0, str(ROOT))
+
+from lme.classification import KNeighborsClusterClassifier  # noqa: E402
+from lme.utils import read_dataset, to_common_samples  # noqa: E402
+
+
+def load_reference():
+    signatures = read_dataset(ROOT.joinpath('datasets', 'pan_cohort_signatures.tsv.gz')).T
+    annotation = read_dataset(ROOT.joinpath('datasets', 'pan_cohort_annotation.tsv'))
+    annotation = annotation[(annotation.Diagnosis == 'Diffuse_Large_B_Cell_Lymphoma') & (~annotation.LME.isna())]
+    return to_common_samples([signatures, annotation.LME])
+
+
+def resample(X, y, size, noise, rng):
+    picks = rng.integers(0, len(X), size)
+    values = X.values[picks] + rng.normal(0, noise, (size, X.shape[1]))
+    index = [f'synthetic_{i}' for i in range(size)]
+    return pd.DataFrame(values, index=index, columns=X.columns), pd.Series(y.values[picks], index=index, name=y.name)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reference-size', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--noise', type=float, default=0.3)
+    parser.add_argument('--n-lists', type=int, default=None)
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    X, y = load_reference()
+    reference_X, reference_y = resample(X, y, args.reference_size, args.noise, rng)
+    queries, _ = resample(X, y, args.queries, args.noise, rng)
+
+    exact, fit_time = timed(KNeighborsClusterClassifier(norm=False, clip=3).fit, reference_X, reference_y)
+    exact_labels, query_time = timed(exact.predict, queries)
+    results = [{'backend': 'exact', 'fit_s': fit_time, 'ms_per_sample': 1000 * query_time / len(queries),
+                'agreement': 1.0}]
+
+    for n_probe in args.n_probe:
+        params = {'n_lists': args.n_lists, 'n_probe': n_probe}
+        model, fit_time = timed(KNeighborsClusterClassifier(norm=False, clip=3, algorithm='ivf',
+                                                            backend_params=params).fit, reference_X, reference_y)
+        labels, query_time = timed(model.predict, queries)
+        results.append({'backend': 'ivf', **params, 'fit_s': fit_time,
+                        'ms_per_sample': 1000 * query_time / len(queries),
+                        'agreement': float((labels == exact_labels).mean())})
+
+    print(pd.DataFrame(results).to_string(index=False))
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump({'reference_size': args.reference_size, 'queries': args.queries, 'results': results},
+                      handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
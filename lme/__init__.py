@@ -0,0 +1,39 @@
+"""
+LME classification of B-cell lymphoma microenvironment.
+Submodules and heavy dependencies (scikit-learn, matplotlib, seaborn, umap) are imported on first use,
+so `import lme` is cheap and scoring workers never load plotting libraries.
+"""
+import importlib
+
+_API = {
+    'read_dataset': 'lme.utils',
+    'read_gene_sets': 'lme.utils',
+    'GeneSet': 'lme.gene_sets',
+    'CompiledGeneSets': 'lme.gene_sets',
+    'ssgsea_formula': 'lme.utils',
+    'ssgsea_formula_chunked': 'lme.utils',
+    'iter_ssgsea_formula': 'lme.utils',
+    'median_scale': 'lme.utils',
+    'MedianScaler': 'lme.utils',
+    'update_gene_names': 'lme.utils',
+    'to_common_samples': 'lme.utils',
+    'run_progeny': 'lme.pathway_scoring',
+    'ProgenyScorer': 'lme.pathway_scoring',
+    'KNeighborsClusterClassifier': 'lme.classification',
+    'LMEPipeline': 'lme.pipeline',
+    'build_reference_model': 'lme.pipeline',
+}
+
+__all__ = list(_API)
+
+
+def __getattr__(name):
+    if name not in _API:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_API[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,4 @@
+from lme.pipeline import main
+
+if __name__ == '__main__':
+    main()
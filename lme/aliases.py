@@ -0,0 +1,106 @@
+import pickle
+from pathlib import Path
+
+import pandas as pd
+
+DEFAULT_ALIAS_TABLE = Path(__file__).resolve().parent.parent.joinpath('databases', 'hgnc_aliases.tsv')
+
+
+class GeneAliasIndex(object):
+    def __init__(self, related):
+        """
+        Offline gene alias lookup
+        :param related: dict {gene name -> frozenset of names of the same gene (approved, aliases, previous)}
+        """
+        self.related = related
+
+    def __contains__(self, gene):
+        return gene in self.related
+
+    def __len__(self):
+        return len(self.related)
+
+    def aliases(self, gene):
+        """
+        Return all known names of a gene including the gene itself
+        :param gene: str, gene name
+        :return: frozenset, empty if gene is unknown
+        """
+        return self.related.get(gene, frozenset())
+
+    @classmethod
+    def from_table(cls, table, symbol_col='symbol', alias_cols=('alias_symbol', 'prev_symbol'), sep='\t',
+                   list_sep='|'):
+        """
+        Build the index from an HGNC-style table, one approved gene per row
+        Default column names match HGNC complete set (hgnc_complete_set.txt)
+        :param table: str or Path, path to the table, or pd.DataFrame
+        :param symbol_col: str, column with approved symbols
+        :param alias_cols: list of columns with alias and previous symbols
+        :param sep: str, column separator of the table file
+        :param list_sep: str, separator of multiple names within a cell
+        :return: GeneAliasIndex
+        """
+        if isinstance(table, pd.DataFrame):
+            df = table
+        else:
+            df = pd.read_csv(table, sep=sep, usecols=[symbol_col, *alias_cols], dtype=str, keep_default_na=False)
+
+        related = {}
+        for row in df[[symbol_col, *alias_cols]].itertuples(index=False):
+            names = set()
+            for cell in row:
+                if isinstance(cell, str):
+                    names.update(name.strip() for name in cell.split(list_sep))
+            names.discard('')
+            names = frozenset(names)
+            for name in names:
+                related[name] = related[name] | names if name in related else names
+
+        return cls(related)
+
+    def save(self, path):
+        """
+        Persist the index to disk
+        :param path: str or Path
+        """
+        with open(path, 'wb') as handle:
+            pickle.dump(self.related, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the index stored with save
+        :param path: str or Path
+        :return: GeneAliasIndex
+        """
+        with open(path, 'rb') as handle:
+            return cls(pickle.load(handle))
+
+
+_loaded = {}
+
+
+def load_alias_index(table=DEFAULT_ALIAS_TABLE, cache=None):
+    """
+    Return GeneAliasIndex for an HGNC-style table, loaded once per process.
+    A missing table is not remembered: a table or cache added later is loaded by the next call
+    :param table: str or Path, path to the table, see GeneAliasIndex.from_table
+    :param cache: str or Path, path to a persisted index. It is read if exists and written after the table is parsed
+    :return: GeneAliasIndex or None if neither cache nor table exists
+    """
+    key = (str(table), None if cache is None else str(cache))
+    if key in _loaded:
+        return _loaded[key]
+
+    if cache is not None and Path(cache).exists():
+        index = GeneAliasIndex.load(cache)
+    elif Path(table).exists():
+        index = GeneAliasIndex.from_table(table)
+        if cache is not None:
+            index.save(cache)
+    else:
+        return None
+
+    _loaded[key] = index
+    return index
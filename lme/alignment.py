@@ -0,0 +1,104 @@
+"""
+Index alignment by integer positions. Labels are matched with pd.Index.intersection and get_indexer, the order of
+the first index is kept, and frames which are already aligned are returned without copying.
+Duplicated labels are resolved by an explicit policy:
+'first', 'last' - keep one occurrence; 'sum', 'mean', 'max' - aggregate values of duplicated columns;
+'error' - raise.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+DUPLICATE_POLICIES = ('first', 'last', 'sum', 'mean', 'max', 'error')
+POSITIONAL_POLICIES = ('first', 'last', 'error')
+
+
+def check_policy(duplicates, policies=DUPLICATE_POLICIES):
+    if duplicates not in policies:
+        raise Exception(f'Unknown duplicates policy: {duplicates}, expected one of {", ".join(policies)}')
+
+
+def common_index(indexes):
+    """
+    Labels present in all indexes, in the order of the first one, each label once
+    :param indexes: list of pd.Index
+    :return: pd.Index
+    """
+    common = pd.Index(indexes[0]).drop_duplicates()
+    for index in indexes[1:]:
+        common = common.intersection(index, sort=False)
+    return common
+
+
+def index_positions(index, labels, duplicates='first'):
+    """
+    Integer positions of labels in index, -1 for labels not found
+    :param index: pd.Index
+    :param labels: list-like
+    :param duplicates: str, 'first', 'last' or 'error', occurrence of a duplicated index label to take
+    :return: np.ndarray of int
+    """
+    check_policy(duplicates, POSITIONAL_POLICIES)
+    index = pd.Index(index)
+    if index.is_unique:
+        return index.get_indexer(labels)
+
+    duplicated = index[index.duplicated()].unique()
+    if duplicates == 'error':
+        raise Exception('Duplicated labels: {}'.format(', '.join(map(str, duplicated[:10]))))
+    kept = np.flatnonzero(~index.duplicated(keep=duplicates))
+    positions = index[kept].get_indexer(labels)
+    return np.where(positions >= 0, kept[positions], -1)
+
+
+def take(data, positions, axis=0):
+    """
+    Rows (axis=0) or columns (axis=1) of data at positions; data itself if positions select everything in order
+    :param data: pd.DataFrame or pd.Series
+    :param positions: np.ndarray of int, no missing (-1) positions
+    :return: pd.DataFrame or pd.Series
+    """
+    positions = np.asarray(positions)
+    if len(positions) == data.shape[axis] and np.array_equal(positions, np.arange(len(positions))):
+        return data
+    return data.iloc[positions] if axis == 0 else data.iloc[:, positions]
+
+
+def deduplicate_columns(data, duplicates='first'):
+    """
+    Make column labels (e.g. gene symbols) unique. Columns are kept in the order of the kept occurrences,
+    aggregated columns - at their first occurrence
+    :param data: pd.DataFrame, rows - samples, columns - genes
+    :param duplicates: str, see DUPLICATE_POLICIES; aggregation skips NaN as pandas does
+    :return: pd.DataFrame, data itself if there are no duplicated columns
+    """
+    check_policy(duplicates)
+    columns = data.columns
+    if columns.is_unique:
+        return data
+    duplicated = columns.duplicated(keep=False)
+    if duplicates == 'error':
+        raise Exception('Duplicated columns: {}'.format(', '.join(map(str, columns[duplicated].unique()[:10]))))
+    warnings.warn(f'{columns[duplicated].nunique()} duplicated column labels, policy: {duplicates}')
+    if duplicates in ('first', 'last'):
+        return data.iloc[:, np.flatnonzero(~columns.duplicated(keep=duplicates))]
+
+    # Only duplicated columns are aggregated: sorted by label, reduced within runs of equal labels
+    positions = np.flatnonzero(duplicated)
+    codes, labels = pd.factorize(columns[positions])
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+    values = np.asarray(data.values[:, positions[order]], dtype=np.float64)
+    known = ~np.isnan(values)
+    if duplicates == 'max':
+        aggregated = np.fmax.reduceat(values, starts, axis=1)
+    else:
+        aggregated = np.add.reduceat(np.where(known, values, 0), starts, axis=1)
+        if duplicates == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                aggregated /= np.add.reduceat(known, starts, axis=1)
+
+    result = data.iloc[:, np.flatnonzero(~columns.duplicated(keep='first'))].copy()
+    result.iloc[:, result.columns.get_indexer(labels)] = aggregated
+    return result
@@ -0,0 +1,157 @@
+"""
+Batch effect diagnostics: distribution shift of every signature between batches and the reference cohort.
+Two-sample Kolmogorov-Smirnov statistics and energy distances of all signatures of a batch are computed
+from one sort of the pooled values.
+
+    signatures = LMEPipeline().score(expression)
+    gate = batch_effects(signatures, batches=annotation.Batch)
+    gate[~gate.passed]
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from lme.utils import median_scale, read_dataset, to_common_samples
+
+SHIFT_STATISTICS = ['ks', 'ks_pvalue', 'energy', 'median_shift']
+
+
+def load_reference_signatures(signatures=None, annotation=None, diagnosis='Diffuse_Large_B_Cell_Lymphoma'):
+    """
+    Median scaled signatures of the reference cohort samples used to fit the LME model
+    :param signatures: str or Path, default - pan-cohort signatures; rows - signatures, columns - samples
+    :param annotation: str or Path, default - pan-cohort annotation
+    :param diagnosis: str, samples of this diagnosis with LME labels are kept, None - all samples
+    :return: pd.DataFrame, rows - samples, columns - signatures
+    """
+    from lme.pipeline import REFERENCE_COHORT_ANNOTATION, REFERENCE_COHORT_EXPRESSION
+
+    reference = read_dataset(signatures or REFERENCE_COHORT_EXPRESSION).T
+    if diagnosis is None:
+        return reference
+    cohort_ann = read_dataset(annotation or REFERENCE_COHORT_ANNOTATION)
+    cohort_ann = cohort_ann[(cohort_ann.Diagnosis == diagnosis) & (~cohort_ann.LME.isna())]
+    return reference.loc[reference.index.isin(cohort_ann.index)]
+
+
+def distribution_shift(reference, batch):
+    """
+    Two-sample statistics for every column. Pooled values of each column are sorted once, empirical CDFs of both
+    samples are cumulative counts over the pooled order
+    :param reference: pd.DataFrame, rows - samples, columns - signatures
+    :param batch: pd.DataFrame with the same columns
+    :return: pd.DataFrame, rows - signatures, columns - ks (Kolmogorov-Smirnov statistic), ks_pvalue (asymptotic),
+        energy (energy distance, as scipy.stats.energy_distance), median_shift (difference of medians in units of
+        the reference MAD)
+    """
+    from scipy.stats import kstwobign
+
+    reference_values = np.asarray(reference.values, dtype=np.float64)
+    batch_values = np.asarray(batch[reference.columns].values, dtype=np.float64)
+    n_reference, n_batch = len(reference_values), len(batch_values)
+
+    pooled = np.concatenate([reference_values, batch_values])
+    order = np.argsort(pooled, axis=0, kind='stable')
+    ordered = np.take_along_axis(pooled, order, axis=0)
+    from_reference = order < n_reference
+    cdf_difference = (np.cumsum(from_reference, axis=0) / n_reference -
+                      np.cumsum(~from_reference, axis=0) / n_batch)
+
+    # CDFs are compared after the last of equal values
+    group_end = np.ones(ordered.shape, dtype=bool)
+    group_end[:-1] = ordered[1:] != ordered[:-1]
+    ks = np.where(group_end, np.abs(cdf_difference), 0).max(axis=0)
+    energy = np.sqrt(2 * (cdf_difference[:-1] ** 2 * np.diff(ordered, axis=0)).sum(axis=0))
+
+    effective_n = np.sqrt(n_reference * n_batch / (n_reference + n_batch))
+    reference_median = np.median(reference_values, axis=0)
+    reference_mad = np.median(np.abs(reference_values - reference_median), axis=0)
+    reference_mad[reference_mad == 0] = np.nan
+    median_shift = (np.median(batch_values, axis=0) - reference_median) / reference_mad
+
+    return pd.DataFrame({'ks': ks, 'ks_pvalue': kstwobign.sf(effective_n * ks), 'energy': energy,
+                         'median_shift': median_shift}, index=reference.columns, columns=SHIFT_STATISTICS)
+
+
+def batch_shift_statistics(signatures, batches=None, reference=None, scale=True, clip=None):
+    """
+    Distribution shift statistics of every signature of every batch against the reference
+    :param signatures: pd.DataFrame, ssGSEA and PROGENy scores of new samples; rows - samples, columns - signatures
+    :param batches: pd.Series of batch labels for samples, None - all samples are one batch
+    :param reference: pd.DataFrame, reference signatures; rows - samples, columns - signatures,
+        default - load_reference_signatures()
+    :param scale: bool, median scale each batch as the reference was scaled
+    :param clip: float, median_scale clip value of the reference, default - the largest absolute reference value
+        (6 for the pan-cohort signatures)
+    :return: pd.DataFrame, rows - (batch, signature), columns - see distribution_shift and samples.
+        Statistics of batches with less than 2 complete samples are NaN, samples is then the batch size
+    """
+    if reference is None:
+        reference = load_reference_signatures()
+    if batches is None:
+        batches = pd.Series('batch', index=signatures.index)
+    else:
+        signatures, batches = to_common_samples([signatures, batches])
+
+    columns = [column for column in reference.columns if column in signatures.columns]
+    if len(columns) < len(reference.columns):
+        warnings.warn('Signatures missing in batches: {}'.format(
+            ', '.join(c for c in reference.columns if c not in columns)))
+    reference = reference[columns].dropna()
+    if clip is None:
+        clip = np.abs(reference.values).max()
+
+    statistics = {}
+    for batch, samples in batches.groupby(batches).groups.items():
+        batch_signatures = signatures.loc[samples, columns]
+        n_samples = len(batch_signatures)
+        if scale:
+            batch_signatures = median_scale(batch_signatures, clip)
+        batch_signatures = batch_signatures.dropna()
+        if len(batch_signatures) < 2:
+            warnings.warn(f'Batch {batch} has less than 2 complete samples and can not be assessed')
+            statistics[batch] = pd.DataFrame(np.nan, index=reference.columns, columns=SHIFT_STATISTICS).assign(
+                samples=n_samples)
+            continue
+        statistics[batch] = distribution_shift(reference, batch_signatures).assign(samples=len(batch_signatures))
+
+    return pd.concat(statistics, names=['batch', 'signature'])
+
+
+def batch_effect_gate(statistics, max_ks=0.2, alpha=0.001, max_shifted=0):
+    """
+    One row per batch to decide if it can be classified
+    A signature is shifted if its KS statistic is above max_ks and significant at alpha
+    :param statistics: pd.DataFrame, see batch_shift_statistics
+    :param max_shifted: int, maximal number of shifted signatures of a batch that passes
+    :return: pd.DataFrame, rows - batches, columns - samples, max_ks, worst_signature, mean_energy,
+        shifted (number of shifted signatures), shifted_signatures, assessable (at least 2 complete samples), passed
+    """
+    shifted = (statistics.ks > max_ks) & (statistics.ks_pvalue < alpha)
+    grouped = statistics.groupby(level='batch', sort=False)
+    assessable = statistics.ks.notna().groupby(level='batch', sort=False).any()
+    worst = statistics.ks.fillna(-np.inf).groupby(level='batch', sort=False).idxmax()
+    gate = pd.DataFrame({
+        'samples': grouped.samples.first(),
+        'max_ks': grouped.ks.max(),
+        'worst_signature': worst.map(lambda index: index[1]).where(assessable, ''),
+        'mean_energy': grouped.energy.mean(),
+        'shifted': shifted.groupby(level='batch', sort=False).sum(),
+        'shifted_signatures': shifted[shifted].reset_index(level='signature').groupby(level='batch').signature.agg(
+            ', '.join),
+        'assessable': assessable,
+    })
+    gate['shifted_signatures'] = gate.shifted_signatures.fillna('')
+    # Batches which can not be assessed are not blocked, e.g. single samples scaled by a reference scaler
+    gate['passed'] = gate.shifted <= max_shifted
+    return gate
+
+
+def batch_effects(signatures, batches=None, reference=None, scale=True, max_ks=0.2, alpha=0.001, max_shifted=0):
+    """
+    Gating table of batches against the reference, see batch_shift_statistics and batch_effect_gate
+    :return: pd.DataFrame, rows - batches
+    """
+    statistics = batch_shift_statistics(signatures, batches=batches, reference=reference, scale=scale)
+    return batch_effect_gate(statistics, max_ks=max_ks, alpha=alpha, max_shifted=max_shifted)
@@ -1,47 +1,120 @@
-import copy
+import json
+import warnings
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from sklearn.neighbors import KNeighborsClassifier
 
-from lme.utils import median_scale
+from lme.neighbors import NEIGHBOR_BACKENDS
+from lme.profiling import instrument, stage
+from lme.result_cache import content_hash
+from lme.utils import MedianScaler, median_scale_array
+
+MODEL_ARTIFACT_VERSION = 1
 
 
 class KNeighborsClusterClassifier:
-    def __init__(self, norm=True, algorithm='auto', clip=2, scale=False, k=35):
+    def __init__(self, norm=True, algorithm='auto', clip=2, scale=False, k=35, backend_params=None, scaler=None,
+                 dtype='float64'):
         """
         Classification using KNN. Fit with signature matrix and labels. Predict on the signatures.
         To use training cohort parameters for scaling set norm=True (If the cohorts are from the same batch)
         Data sets from different batches should be scaled
         :param norm:
-        :param algorithm:
+        :param algorithm: sklearn KNeighborsClassifier algorithm or a key of lme.neighbors.NEIGHBOR_BACKENDS
+            (e.g. 'ivf' for approximate search on large reference cohorts)
         :param clip:
-        :param scale:
+        :param scale: False, True - median scale every data set by its own statistics,
+            'reference' - scale by statistics stored in scaler (fitted on the training data if not provided),
+            samples are then classified independently of the batch
         :param k:
+        :param backend_params: dict, parameters of the lme.neighbors backend
+        :param scaler: MedianScaler, reference statistics for scale='reference'.
+            If its update_rate is set, the statistics are updated with every predicted batch
+        :param dtype: numpy float dtype of preprocessed data and the reference matrix, e.g. 'float32'
         """
         self.norm = norm
         self.median = 0
         self.mad = 1
         self.X = None
         self.y = None
+        self.y_codes = None
         self.algorithm = algorithm
         self.model = None
         self.clip = clip
         self.scale = scale
         self.k = k
+        self.backend_params = backend_params
+        self.scaler = scaler
+        self.dtype = np.dtype(dtype)
 
     def check_is_fitted(self):
         return (self.X is not None) and (self.y is not None) and (self.model is not None)
 
-    def preprocess_data(self, X):
-        x = copy.deepcopy(X)
-        if self.scale:
-            x = median_scale(x)
+    def fingerprint(self):
+        """
+        Content hash of parameters, reference data and scaling statistics, identifies cached predictions
+        :return: str
+        """
+        scaler = self.scaler
+        scaler_stats = [] if scaler is None else [scaler.median, scaler.mad, scaler.mean]
+        return content_hash({'norm': self.norm, 'algorithm': self.algorithm, 'clip': self.clip, 'scale': self.scale,
+                             'k': self.k, 'backend_params': self.backend_params, 'dtype': self.dtype.name},
+                            self.X, self.y, self.median, self.mad, *scaler_stats)
 
-        x = (x - self.median) / self.mad
+    def cacheable(self):
+        """
+        Predictions depend only on the sample itself: no per batch scaling and no scaler updates
+        """
+        if self.scale is True:
+            return False
+        return self.scale != 'reference' or self.scaler is None or self.scaler.update_rate is None
+
+    def feature_stat(self, stat, columns, dtype=np.float64):
+        """
+        Return median/MAD as a value or an array aligned with columns
+        """
+        if isinstance(stat, pd.Series):
+            if columns is not None:
+                stat = stat.reindex(columns)
+            return stat.values.astype(dtype)
+        return stat
+
+    def preprocess_array(self, X, dtype=None, update_scaler=False):
+        """
+        Preprocess data into a single new numpy buffer. Median scaling, centering, scaling and clipping
+        are applied in place, no intermediate DataFrames are created
+        :param X: pd.DataFrame, RNA data, columns - features, index - samples
+        :param dtype: numpy float dtype of the result, default - self.dtype
+        :param update_scaler: bool, update running statistics of the reference scaler with X
+        :return: np.ndarray, samples x features
+        """
+        dtype = dtype or self.dtype
+        X = self.check_columns(X)
+        columns = X.columns if hasattr(X, 'columns') else None
+        x = np.array(X, dtype=dtype)
+
+        if self.scale == 'reference':
+            self.scaler.transform_array(x, columns)
+            if update_scaler:
+                self.scaler.update(X)
+        elif self.scale:
+            median_scale_array(x)
+
+        median = self.feature_stat(self.median, columns, dtype)
+        mad = self.feature_stat(self.mad, columns, dtype)
+        if not (np.isscalar(median) and median == 0):
+            x -= median
+        if not (np.isscalar(mad) and mad == 1):
+            x /= mad
         if self.clip is not None and self.clip > 0:
-            x = x.clip(-1 * self.clip, self.clip)
+            np.clip(x, -1 * self.clip, self.clip, out=x)
         return x
 
+    def preprocess_data(self, X):
+        x = self.check_columns(X)
+        return pd.DataFrame(self.preprocess_array(x), index=x.index, columns=x.columns, copy=False)
+
     def check_columns(self, X):
         if hasattr(self.X, 'columns'):
             try:
@@ -50,25 +123,48 @@ class KNeighborsClusterClassifier:
                 raise Exception('Columns do not match')
         return X
 
-    def fit(self, X, y):
+    def model_input(self, x):
+        """
+        Wrap a preprocessed array for the sklearn model, without copying
+        Models fitted on DataFrames (e.g. loaded from older artifacts) expect feature names
+        """
+        if hasattr(self.model, 'feature_names_in_'):
+            return pd.DataFrame(x, columns=self.model.feature_names_in_, copy=False)
+        return x
+
+    @instrument()
+    def fit(self, X, y, statistics=None):
         """
         :param X: pd.DataFrame, RNA data, columns - features, index - samples
         :param y: pd.Series, cluster labels
+        :param statistics: MedianScaler with median and MAD of a larger cohort (see lme.streaming_stats), used instead
+            of statistics of X for the reference scaler and norm
         """
         if X.shape[0] != len(y):
             raise Exception('Shapes do not match')
 
+        if self.scale == 'reference' and self.scaler is None:
+            self.scaler = MedianScaler().fit(X) if statistics is None else statistics
+
         if self.norm:
-            self.median = X.median()
-            self.mad = X.mad()
+            self.median = X.median() if statistics is None else statistics.median[X.columns]
+            self.mad = X.mad() if statistics is None else statistics.mad[X.columns]
 
         self.X = self.preprocess_data(X)
-        self.y = copy.deepcopy(y)
+        self.y = y.copy()
+        # Codes of labels in the sorted classes, as classes_ of the fitted model
+        _, self.y_codes = np.unique(np.asarray(self.y.values), return_inverse=True)
 
-        self.model = KNeighborsClassifier(algorithm=self.algorithm, n_neighbors=self.k).fit(self.X, self.y)
+        if self.algorithm in NEIGHBOR_BACKENDS:
+            model = NEIGHBOR_BACKENDS[self.algorithm](n_neighbors=self.k, **(self.backend_params or {}))
+        else:
+            from sklearn.neighbors import KNeighborsClassifier
+            model = KNeighborsClassifier(algorithm=self.algorithm, n_neighbors=self.k)
+        self.model = model.fit(self.X.values, self.y.values)
 
         return self
 
+    @instrument()
     def predict(self, X):
         """
         Predict - return a pd.Series with the predicted cluster labels
@@ -79,20 +175,206 @@ class KNeighborsClusterClassifier:
         if X.shape[1] != self.X.shape[1]:
             raise Exception('Shapes do not match')
 
-        x_scaled = self.preprocess_data(self.check_columns(X))
+        x_scaled = self.preprocess_array(X, update_scaler=True)
         # Here self.model.predict is used in order to mimic its' way to select the class in case of equal probabilities
-        return pd.Series(self.model.predict(x_scaled), index=x_scaled.index)
+        return pd.Series(self.model.predict(self.model_input(x_scaled)), index=X.index)
 
-    def predict_proba(self, X):
+    @instrument()
+    def predict_proba(self, X, result_cache=None):
         """
         :param X: pd.DataFrame, RNA data, columns - features, index - samples
+        :param result_cache: lme.result_cache.ResultCache, predict only samples without stored probabilities.
+            Ignored if predictions depend on the batch (scale=True or an updated reference scaler)
         :return: pd.DataFrame, probabilities for each cluster. Index - samples, columns - clusters
         """
+        if result_cache is not None and self.cacheable():
+            return self.cached_proba(X, result_cache)
 
         if X.shape[1] != self.X.shape[1]:
             raise Exception('Shapes do not match')
 
-        x_scaled = self.preprocess_data(self.check_columns(X))
+        x_scaled = self.preprocess_array(X, update_scaler=True)
 
-        return pd.DataFrame(self.model.predict_proba(x_scaled).astype(float), index=x_scaled.index,
+        return pd.DataFrame(self.model.predict_proba(self.model_input(x_scaled)).astype(float), index=X.index,
                             columns=self.model.classes_)
+
+    @instrument()
+    def predict_with_proba(self, X, return_neighbors=False, result_cache=None):
+        """
+        Predict labels and probabilities with a single neighbors query
+        Labels are selected as in predict: the first class (in self.model.classes_ order) among equally probable
+
+        :param X: pd.DataFrame, RNA data, columns - features, index - samples
+        :param return_neighbors: bool, also return reference samples used as neighbors and distances to them
+        :param result_cache: lme.result_cache.ResultCache, see predict_proba. Not used with return_neighbors
+        :return: (pd.Series, pd.DataFrame), predicted cluster labels and probabilities for each cluster.
+            With return_neighbors - also pd.DataFrame of neighbor sample ids and pd.DataFrame of distances,
+            index - samples, columns - neighbor number (nearest first)
+        """
+        if result_cache is not None and self.cacheable() and not return_neighbors:
+            proba = self.cached_proba(X, result_cache)
+            return pd.Series(self.model.classes_[proba.values.argmax(axis=1)], index=X.index), proba
+
+        if X.shape[1] != self.X.shape[1]:
+            raise Exception('Shapes do not match')
+
+        x_scaled = self.preprocess_array(X, update_scaler=True)
+        with stage('kneighbors', x_scaled):
+            distances, indices = self.model.kneighbors(self.model_input(x_scaled))
+
+        classes = self.model.classes_
+        proba = self.neighbor_votes(indices)
+
+        labels = pd.Series(classes[proba.argmax(axis=1)], index=X.index)
+        proba = pd.DataFrame(proba, index=X.index, columns=classes)
+        if not return_neighbors:
+            return labels, proba
+
+        neighbors = pd.DataFrame(np.asarray(self.X.index)[indices], index=X.index)
+        distances = pd.DataFrame(distances, index=X.index)
+        return labels, proba, neighbors, distances
+
+    def neighbor_votes(self, indices):
+        """
+        Uniform votes of reference neighbors
+        :param indices: np.ndarray, positions of neighbors in self.X, rows - samples
+        :return: np.ndarray, probabilities of self.model.classes_, rows - samples
+        """
+        if self.y_codes is None:
+            self.y_codes = self.label_codes(self.y)
+        neighbor_codes = self.y_codes[indices]
+        counts = np.zeros((len(indices), len(self.model.classes_)))
+        np.add.at(counts, (np.arange(len(indices))[:, np.newaxis], neighbor_codes), 1)
+        return counts / counts.sum(axis=1, keepdims=True)
+
+    def label_codes(self, y):
+        """
+        Positions of labels in self.model.classes_
+        :param y: pd.Series or np.ndarray of labels
+        :return: np.ndarray of int
+        """
+        codes = pd.Index(self.model.classes_).get_indexer(np.asarray(y))
+        if (codes < 0).any():
+            raise Exception('Labels {} are not classes of the model'.format(
+                ', '.join(map(str, pd.unique(np.asarray(y)[codes < 0])))))
+        return codes
+
+    def preprocess_replicates(self, replicates):
+        """
+        Preprocess replicates (e.g. perturbations) of the same samples into one matrix for a single neighbors query.
+        Every replicate is preprocessed as a separate data set, the reference scaler is not updated
+        :param replicates: np.ndarray, replicates x samples x features, features - columns of self.X
+        :return: np.ndarray, (replicates * samples) x features, replicates one after another
+        """
+        n_replicates, n_samples, n_features = replicates.shape
+        x = np.empty((n_replicates * n_samples, n_features), dtype=self.dtype)
+        for i, replicate in enumerate(replicates):
+            x[i * n_samples:(i + 1) * n_samples] = self.preprocess_array(
+                pd.DataFrame(replicate, columns=self.X.columns, copy=False))
+        return x
+
+    def preprocessed_proba(self, x):
+        """
+        :param x: np.ndarray, preprocessed samples, see preprocess_replicates
+        :return: np.ndarray, probabilities of self.model.classes_, rows - samples
+        """
+        with stage('kneighbors', x):
+            indices = self.model.kneighbors(self.model_input(x), return_distance=False)
+        return self.neighbor_votes(indices)
+
+    def cached_proba(self, X, result_cache):
+        """
+        Probabilities from result_cache, computed with predict_with_proba for samples not found
+        """
+        proba = result_cache.cached(f'knn:{self.fingerprint()}', X, lambda missing: self.predict_with_proba(missing)[1])
+        proba.columns = self.model.classes_
+        return proba
+
+    def save(self, path):
+        """
+        Save the fitted model to a directory: preprocessed reference matrix, labels, median/MAD and the fitted
+        sklearn model. Arrays are stored uncompressed so that load can memory-map them
+        :param path: str or Path, directory to write
+        """
+        import joblib
+        import sklearn
+
+        if not self.check_is_fitted():
+            raise Exception('Model is not fitted')
+
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        np.save(path / 'X.npy', np.ascontiguousarray(self.X.values))
+        np.save(path / 'y.npy', np.asarray(self.y.values).astype(str))
+        # Labels are restored from codes and classes of the pickled model, y.npy keeps them as strings
+        np.save(path / 'y_codes.npy', self.label_codes(self.y))
+        np.save(path / 'median.npy', np.asarray(self.median, dtype=float))
+        np.save(path / 'mad.npy', np.asarray(self.mad, dtype=float))
+        joblib.dump(self.model, path / 'model.joblib')
+        if self.scaler is not None:
+            self.scaler.save(path / 'scaler.tsv')
+
+        metadata = {
+            'version': MODEL_ARTIFACT_VERSION,
+            'sklearn_version': sklearn.__version__,
+            'params': {'norm': self.norm, 'algorithm': self.algorithm, 'clip': self.clip, 'scale': self.scale,
+                       'k': self.k, 'backend_params': self.backend_params, 'dtype': self.dtype.name},
+            'columns': [str(c) for c in self.X.columns],
+            'index': [str(i) for i in self.X.index],
+            'y_name': self.y.name,
+            'scaler_update_rate': None if self.scaler is None else self.scaler.update_rate,
+        }
+        with open(path / 'metadata.json', 'w') as handle:
+            json.dump(metadata, handle)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a model written with save
+        :param path: str or Path, model directory
+        :param mmap: bool, memory-map arrays (read-only) instead of reading them into memory.
+            Processes loading the same artifact share the page-cached arrays
+        :return: KNeighborsClusterClassifier
+        """
+        import joblib
+        import sklearn
+
+        path = Path(path)
+        with open(path / 'metadata.json') as handle:
+            metadata = json.load(handle)
+
+        if metadata['version'] != MODEL_ARTIFACT_VERSION:
+            raise Exception('Model artifact version {} is not supported, expected {}'.format(
+                metadata['version'], MODEL_ARTIFACT_VERSION))
+        if metadata['sklearn_version'] != sklearn.__version__:
+            warnings.warn('Model was saved with scikit-learn {}, loaded with {}'.format(
+                metadata['sklearn_version'], sklearn.__version__))
+
+        mmap_mode = 'r' if mmap else None
+        model = cls(**metadata['params'])
+        model.X = pd.DataFrame(np.load(path / 'X.npy', mmap_mode=mmap_mode), index=metadata['index'],
+                               columns=metadata['columns'], copy=False)
+
+        median = np.load(path / 'median.npy')
+        mad = np.load(path / 'mad.npy')
+        if median.ndim:
+            model.median = pd.Series(median, index=model.X.columns)
+            model.mad = pd.Series(mad, index=model.X.columns)
+        else:
+            model.median = float(median)
+            model.mad = float(mad)
+
+        model.model = joblib.load(path / 'model.joblib', mmap_mode=mmap_mode)
+        classes = model.model.classes_
+        if (path / 'y_codes.npy').exists():
+            y_codes = np.load(path / 'y_codes.npy')
+        else:
+            y_codes = pd.Index(classes.astype(str)).get_indexer(np.load(path / 'y.npy'))
+            if (y_codes < 0).any():
+                raise Exception('Labels of y.npy are not classes of the model')
+        model.y = pd.Series(classes[y_codes], index=model.X.index, name=metadata['y_name'])
+        model.y_codes = y_codes
+        if (path / 'scaler.tsv').exists():
+            model.scaler = MedianScaler.load(path / 'scaler.tsv', update_rate=metadata.get('scaler_update_rate'))
+        return model
@@ -0,0 +1,166 @@
+import weakref
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from lme.result_cache import content_hash
+
+
+class GeneSet(object):
+    def __init__(self, name, descr, genes):
+        self.name = name
+        self.descr = descr
+        self.genes = set(genes)
+        self.genes_ordered = list(genes)
+
+    def __str__(self):
+        s = ','.join(self.genes)
+        return f'{self.name} ({self.descr}): {s}'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class CompiledGeneSets(object):
+    def __init__(self, names, descriptions, vocabulary, indptr, indices, max_cached=8):
+        """
+        Gene set collection with genes encoded as integer codes of a shared vocabulary.
+        Gene set i consists of vocabulary[indices[indptr[i]:indptr[i + 1]]] (CSR layout).
+        Alignments with expression gene indexes are cached on the index objects.
+        Behaves as a read-only dict {geneset_name : GeneSet object}
+        :param names: list of gene set names
+        :param descriptions: list of gene set descriptions
+        :param vocabulary: np.ndarray of unique gene names
+        :param indptr: np.ndarray, gene set boundaries in indices
+        :param indices: np.ndarray, gene codes
+        :param max_cached: int, number of aligned gene indexes to keep
+        """
+        self.names = list(names)
+        self.descriptions = list(descriptions)
+        self.vocabulary = np.asarray(vocabulary, dtype=str)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.max_cached = max_cached
+        self._positions = {name: i for i, name in enumerate(self.names)}
+        self._aligned = {}
+
+    @classmethod
+    def from_gene_sets(cls, gene_sets):
+        """
+        :param gene_sets: dict, keys - gene set names, values - GeneSet
+        :return: CompiledGeneSets
+        """
+        if isinstance(gene_sets, cls):
+            return gene_sets
+
+        names = list(gene_sets.keys())
+        genes = [sorted(gene_sets[name].genes) for name in names]
+        vocabulary = pd.Index(sorted({gene for gs_genes in genes for gene in gs_genes}))
+        indptr = np.cumsum([0] + [len(gs_genes) for gs_genes in genes])
+        if len(genes):
+            indices = np.concatenate([vocabulary.get_indexer(gs_genes) for gs_genes in genes])
+        else:
+            indices = np.array([], dtype=np.int32)
+        return cls(names, [gene_sets[name].descr for name in names], vocabulary.values, indptr, indices)
+
+    @classmethod
+    def from_gmt(cls, gmt_file):
+        """
+        :param gmt_file: str, path to .gmt file
+        :return: CompiledGeneSets
+        """
+        from lme.utils import read_gene_sets
+        return cls.from_gene_sets(read_gene_sets(gmt_file))
+
+    def save(self, path):
+        """
+        Write the collection to a compressed .npz file
+        :param path: str or Path
+        """
+        np.savez_compressed(path, names=np.asarray(self.names, dtype=str),
+                            descriptions=np.asarray(self.descriptions, dtype=str),
+                            vocabulary=self.vocabulary, indptr=self.indptr, indices=self.indices)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a collection written with save
+        :param path: str or Path
+        :return: CompiledGeneSets
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['names'], data['descriptions'], data['vocabulary'], data['indptr'], data['indices'])
+
+    def fingerprint(self):
+        """
+        Content hash of the collection, identifies cached scores
+        :return: str
+        """
+        return content_hash(self.names, self.vocabulary, self.indptr, self.indices)
+
+    def codes(self, name):
+        i = self._positions[name]
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def membership_matrix(self):
+        """
+        :return: scipy.sparse.csr_matrix, gene sets x vocabulary
+        """
+        return sparse.csr_matrix((np.ones(len(self.indices)), self.indices, self.indptr),
+                                 shape=(len(self.names), len(self.vocabulary)))
+
+    def align(self, genes):
+        """
+        Return a sparse gene set x gene membership matrix aligned with genes
+        Duplicated gene names are all marked as members, like .loc does in ssgsea_score
+        The result is cached for the genes object
+
+        :param genes: pd.Index, gene names
+        :return: (scipy.sparse.csr_matrix, np.ndarray), membership matrix and number of common genes for each gene set
+        """
+        cached = self._aligned.get(id(genes))
+        if cached is not None and cached[0]() is genes:
+            return cached[1]
+
+        gene_codes = pd.Index(self.vocabulary).get_indexer(genes)
+        found = np.flatnonzero(gene_codes >= 0)
+        vocabulary_to_genes = sparse.csr_matrix((np.ones(len(found)), (gene_codes[found], found)),
+                                                shape=(len(self.vocabulary), len(genes)))
+
+        membership = self.membership_matrix()
+        in_genes = np.zeros(len(self.vocabulary))
+        in_genes[gene_codes[found]] = 1
+        aligned = (membership @ vocabulary_to_genes).tocsr(), (membership @ in_genes).astype(int)
+
+        if isinstance(genes, pd.Index):
+            if len(self._aligned) >= self.max_cached:
+                self._aligned.pop(next(iter(self._aligned)))
+            self._aligned[id(genes)] = (weakref.ref(genes), aligned)
+        return aligned
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_aligned'] = {}
+        return state
+
+    def __getitem__(self, name):
+        return GeneSet(name, self.descriptions[self._positions[name]], self.vocabulary[self.codes(name)].tolist())
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    def values(self):
+        return [self[name] for name in self.names]
+
+    def items(self):
+        return [(name, self[name]) for name in self.names]
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+NA_VALUES = ['Na', 'NA', 'NAN']
+CACHE_SUFFIX = '.lmecache'
+CACHE_VERSION = 1
+
+
+def detect_format(path):
+    """
+    Detect dataset format by path: 'parquet', 'feather', 'npy' (directory written by write_npy_dataset) or 'csv'
+    :param path: str or Path
+    :return: str
+    """
+    path = Path(path)
+    if path.is_dir() and path.joinpath('values.npy').exists():
+        return 'npy'
+    suffixes = [s.lower() for s in path.suffixes]
+    if suffixes and suffixes[-1] in ('.parquet', '.pq'):
+        return 'parquet'
+    if suffixes and suffixes[-1] in ('.feather', '.ftr'):
+        return 'feather'
+    return 'csv'
+
+
+def select(df, columns=None, rows=None):
+    """
+    :param df: pd.DataFrame
+    :param columns: list of columns in the required order
+    :param rows: list of index labels, rows present in df are kept in df order
+    :return: pd.DataFrame
+    """
+    if rows is not None:
+        df = df[df.index.isin(rows)]
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def read_csv(path, sep='\t', header=0, index_col=0, comment=None, columns=None, rows=None, dtype=None,
+             chunksize=10000):
+    """
+    Read a text table, selected columns are passed to the parser (usecols),
+    selected rows are filtered and values are converted to dtype by chunks
+    """
+    kwargs = dict(sep=sep, header=header, index_col=index_col, na_values=NA_VALUES, comment=comment)
+    if columns is not None and index_col is not None and header is not None:
+        names = pd.read_csv(path, nrows=0, sep=sep, header=header, comment=comment).columns
+        keep = set(columns) | {names[index_col] if isinstance(index_col, int) else index_col}
+        kwargs['usecols'] = lambda c: c in keep
+
+    if rows is None and dtype is None:
+        return select(pd.read_csv(path, **kwargs), columns)
+
+    with pd.read_csv(path, chunksize=chunksize, **kwargs) as reader:
+        chunks = [as_dtype(select(chunk, columns, rows), dtype) for chunk in reader]
+    return pd.concat(chunks)
+
+
+def as_dtype(df, dtype=None):
+    """
+    :param df: pd.DataFrame
+    :param dtype: numpy dtype or None to keep dtypes
+    :return: pd.DataFrame
+    """
+    if dtype is None:
+        return df
+    return df.astype(dtype, copy=False)
+
+
+def read_npy_dataset(path, columns=None, rows=None, mmap=True, dtype=None):
+    """
+    Read a dataset written with write_npy_dataset. Values are memory-mapped, only selected cells are read
+    :return: pd.DataFrame
+    """
+    path = Path(path)
+    index = pd.Index(np.load(path / 'index.npy'))
+    all_columns = pd.Index(np.load(path / 'columns.npy'))
+    values = np.load(path / 'values.npy', mmap_mode='r' if mmap else None)
+
+    row_positions = np.flatnonzero(index.isin(rows)) if rows is not None else slice(None)
+    if columns is not None:
+        column_positions = all_columns.get_indexer(list(columns))
+        if (column_positions < 0).any():
+            raise KeyError(f'Columns not found: {list(all_columns[column_positions < 0])}')
+    else:
+        column_positions = slice(None)
+
+    selected = np.array(values[row_positions][:, column_positions] if rows is not None
+                        else values[:, column_positions], dtype=dtype)
+    df = pd.DataFrame(selected, index=index[row_positions], columns=all_columns[column_positions], copy=False)
+    if (path / 'names.json').exists():
+        with open(path / 'names.json') as handle:
+            names = json.load(handle)
+        df.index.name, df.columns.name = names['index'], names['columns']
+    return df
+
+
+def write_npy_dataset(df, path):
+    """
+    Write a numeric DataFrame to a directory with values.npy, index.npy and columns.npy
+    :param df: pd.DataFrame
+    :param path: str or Path, directory
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / 'values.npy', np.ascontiguousarray(df.values))
+    np.save(path / 'index.npy', df.index.values.astype(str), allow_pickle=False)
+    np.save(path / 'columns.npy', df.columns.values.astype(str), allow_pickle=False)
+    with open(path / 'names.json', 'w') as handle:
+        json.dump({'index': df.index.name, 'columns': df.columns.name}, handle)
+
+
+def write_dataset(df, path, fmt=None):
+    """
+    Write a DataFrame as 'csv' (tab separated), 'parquet', 'feather' or 'npy'
+    :param df: pd.DataFrame
+    :param path: str or Path
+    :param fmt: str, default - by path, see detect_format
+    """
+    fmt = fmt or detect_format(path)
+    if fmt == 'parquet':
+        df.to_parquet(path)
+    elif fmt == 'feather':
+        df.reset_index().to_feather(path)
+    elif fmt == 'npy':
+        write_npy_dataset(df, path)
+    elif fmt == 'csv':
+        df.to_csv(path, sep='\t')
+    else:
+        raise Exception(f'Unknown format: {fmt}')
+
+
+def is_npy_compatible(df):
+    """
+    Numeric values with string labels can be stored as npy arrays
+    """
+    return all(pd.api.types.is_numeric_dtype(dtype) for dtype in df.dtypes) and \
+        all(pd.api.types.infer_dtype(labels) in ('string', 'empty') for labels in (df.index, df.columns))
+
+
+def file_hash(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cache_location(path, cache):
+    """
+    :param path: Path, source file
+    :param cache: True - sidecar next to the file, str or Path - cache directory
+    :return: Path of the cache entry
+    """
+    if cache is True:
+        return path.with_name(path.name + CACHE_SUFFIX)
+    key = hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:16]
+    return Path(cache) / f'{path.name}.{key}{CACHE_SUFFIX}'
+
+
+def read_cached(path, location, options):
+    """
+    Return the format of the cache entry if it matches the source file (mtime and size, or content hash)
+    and read options, otherwise None
+    """
+    meta_path = location / 'meta.json'
+    if not meta_path.exists():
+        return None
+    with open(meta_path) as handle:
+        meta = json.load(handle)
+    if meta.get('version') != CACHE_VERSION or meta.get('options') != options:
+        return None
+
+    stat = path.stat()
+    if (meta['mtime_ns'], meta['size']) != (stat.st_mtime_ns, stat.st_size):
+        if meta['size'] != stat.st_size or meta['sha1'] != file_hash(path):
+            return None
+        meta['mtime_ns'] = stat.st_mtime_ns
+        with open(meta_path, 'w') as handle:
+            json.dump(meta, handle)
+
+    return meta['format']
+
+
+def write_cache(df, path, location, options):
+    if location.exists():
+        shutil.rmtree(location)
+    location.mkdir(parents=True)
+
+    fmt = 'npy' if is_npy_compatible(df) else 'pickle'
+    if fmt == 'npy':
+        write_npy_dataset(df, location)
+    else:
+        df.to_pickle(location / 'data.pkl')
+
+    stat = path.stat()
+    with open(location / 'meta.json', 'w') as handle:
+        json.dump({'version': CACHE_VERSION, 'options': options, 'format': fmt, 'mtime_ns': stat.st_mtime_ns,
+                   'size': stat.st_size, 'sha1': file_hash(path)}, handle)
+
+
+def read_parquet(path, columns=None, rows=None):
+    """
+    Read a Parquet dataset, selected columns and rows are read by pyarrow (columns=, filters= on the index column)
+    """
+    import pyarrow.parquet as pq
+
+    filters = None
+    if rows is not None:
+        index_columns = (pq.read_schema(path).pandas_metadata or {}).get('index_columns', [])
+        # RangeIndex is not stored as a column, its rows are selected after reading
+        if len(index_columns) == 1 and isinstance(index_columns[0], str):
+            filters = [(index_columns[0], 'in', list(rows))]
+    df = pd.read_parquet(path, columns=list(columns) if columns is not None else None, filters=filters)
+    return df if filters is not None else select(df, rows=rows)
+
+
+def read_feather(path, columns=None, rows=None):
+    """
+    Read a Feather dataset written by write_dataset (index is the first column), selected columns are read by pyarrow
+    """
+    if columns is not None:
+        from pyarrow import ipc
+        index_name = ipc.open_file(path).schema.names[0]
+        columns = [index_name] + [c for c in columns if c != index_name]
+    df = pd.read_feather(path, columns=columns)
+    df = df.set_index(df.columns[0])
+    return select(df, rows=rows)
+
+
+def read_table(file, sep='\t', header=0, index_col=0, comment=None, columns=None, rows=None, cache=False, fmt=None,
+               dtype=None):
+    """
+    Read a dataset in csv/tsv(.gz), Parquet, Feather or npy format, see read_dataset
+    """
+    fmt = fmt or detect_format(file)
+    if fmt == 'parquet':
+        return as_dtype(read_parquet(file, columns=columns, rows=rows), dtype)
+    if fmt == 'feather':
+        return as_dtype(read_feather(file, columns=columns, rows=rows), dtype)
+    if fmt == 'npy':
+        return read_npy_dataset(file, columns=columns, rows=rows, dtype=dtype)
+    if fmt != 'csv':
+        raise Exception(f'Unknown format: {fmt}')
+
+    if not cache:
+        if columns is None and rows is None and dtype is None:
+            return pd.read_csv(file, sep=sep, header=header, index_col=index_col, na_values=NA_VALUES,
+                               comment=comment)
+        return read_csv(file, sep=sep, header=header, index_col=index_col, comment=comment, columns=columns,
+                        rows=rows, dtype=dtype)
+
+    path = Path(file)
+    location = cache_location(path, cache)
+    options = {'sep': sep, 'header': header, 'index_col': index_col, 'comment': comment}
+    cached_format = read_cached(path, location, options)
+    if cached_format is None:
+        write_cache(pd.read_csv(path, sep=sep, header=header, index_col=index_col, na_values=NA_VALUES,
+                                comment=comment), path, location, options)
+        cached_format = read_cached(path, location, options)
+
+    if cached_format == 'npy':
+        return read_npy_dataset(location, columns=columns, rows=rows, dtype=dtype)
+    return as_dtype(select(pd.read_pickle(location / 'data.pkl'), columns, rows), dtype)
@@ -0,0 +1,180 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+def squared_distances(a, b, b_norms=None):
+    """
+    Squared euclidean distances between rows of a and rows of b
+    :param a: np.ndarray, n x d
+    :param b: np.ndarray, m x d
+    :param b_norms: np.ndarray, precomputed squared norms of rows of b
+    :return: np.ndarray, n x m
+    """
+    if b_norms is None:
+        b_norms = np.einsum('ij,ij->i', b, b)
+    d = np.einsum('ij,ij->i', a, a)[:, np.newaxis] - 2 * (a @ b.T) + b_norms[np.newaxis, :]
+    return np.maximum(d, 0, out=d)
+
+
+class NeighborsBackend(ABC):
+    def __init__(self, n_neighbors=35):
+        """
+        Base class for neighbor search backends of KNeighborsClusterClassifier.
+        Mimics the part of sklearn.neighbors.KNeighborsClassifier API used by the classifier.
+        Subclasses implement fit_index and kneighbors, votes are uniform as in KNeighborsClassifier
+        :param n_neighbors: int, number of neighbors
+        """
+        self.n_neighbors = n_neighbors
+        self.classes_ = None
+        self._y = None
+
+    @abstractmethod
+    def fit_index(self, X):
+        """
+        Build the search index over the reference samples
+        :param X: np.ndarray, samples x features
+        """
+
+    @abstractmethod
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """
+        :param X: np.ndarray, query samples x features
+        :param n_neighbors: int, default - self.n_neighbors
+        :param return_distance: bool
+        :return: np.ndarray of distances and np.ndarray of reference positions, queries x n_neighbors, nearest first.
+            Positions only if not return_distance
+        """
+
+    def check_n_neighbors(self, n_neighbors, n_reference):
+        if n_neighbors > n_reference:
+            raise Exception(f'Can not find {n_neighbors} neighbors in a reference of {n_reference} samples, '
+                            f'decrease n_neighbors')
+
+    def fit(self, X, y):
+        """
+        :param X: np.ndarray, samples x features
+        :param y: np.ndarray, labels
+        """
+        self.check_n_neighbors(self.n_neighbors, len(X))
+        self.classes_, self._y = np.unique(np.asarray(y), return_inverse=True)
+        self.fit_index(np.ascontiguousarray(X, dtype=float))
+        return self
+
+    def predict_proba(self, X):
+        indices = self.kneighbors(X, return_distance=False)
+        codes = self._y[indices]
+        counts = np.zeros((len(indices), len(self.classes_)))
+        np.add.at(counts, (np.arange(len(indices))[:, np.newaxis], codes), 1)
+        return counts / counts.sum(axis=1, keepdims=True)
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+class IVFNeighbors(NeighborsBackend):
+    def __init__(self, n_neighbors=35, n_lists=None, n_probe=8, n_iter=10, batch_size=4096, random_state=42):
+        """
+        Approximate neighbor search with an inverted file index: reference samples are split into n_lists
+        k-means clusters, a query is compared only with samples of its n_probe nearest clusters.
+        Recall grows with n_probe, n_probe=n_lists is an exact search
+        :param n_neighbors: int, number of neighbors
+        :param n_lists: int, number of clusters, default - sqrt of the number of reference samples
+        :param n_probe: int, number of clusters to search
+        :param n_iter: int, k-means iterations
+        :param batch_size: int, number of rows to compute distances for at once
+        :param random_state: int
+        """
+        super().__init__(n_neighbors=n_neighbors)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.centroids = None
+        self.list_offsets = None
+        self.order = None
+        self._fit_X = None
+        self._fit_norms = None
+
+    def assign(self, X, centroids, n_nearest=1):
+        """
+        Return indices of the n_nearest centroids for every row of X, nearest first
+        """
+        centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        result = np.empty((len(X), n_nearest), dtype=np.int64)
+        for start in range(0, len(X), self.batch_size):
+            d = squared_distances(X[start:start + self.batch_size], centroids, centroid_norms)
+            if n_nearest < d.shape[1]:
+                nearest = np.argpartition(d, n_nearest - 1, axis=1)[:, :n_nearest]
+            else:
+                nearest = np.tile(np.arange(d.shape[1]), (len(d), 1))
+            nearest = np.take_along_axis(nearest, np.argsort(np.take_along_axis(d, nearest, axis=1), axis=1), axis=1)
+            result[start:start + self.batch_size] = nearest
+        return result
+
+    def fit_index(self, X):
+        rng = np.random.default_rng(self.random_state)
+        n_lists = self.n_lists or max(int(np.sqrt(len(X))), 1)
+        n_lists = min(n_lists, len(X))
+
+        # k-means on a subsample of the reference
+        train = X[rng.choice(len(X), min(len(X), 64 * n_lists), replace=False)]
+        centroids = train[rng.choice(len(train), n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            labels = self.assign(train, centroids)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, train)
+            sizes = np.bincount(labels, minlength=n_lists)
+            non_empty = sizes > 0
+            centroids[non_empty] = sums[non_empty] / sizes[non_empty, np.newaxis]
+
+        labels = self.assign(X, centroids)[:, 0]
+        self.order = np.argsort(labels, kind='stable')
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))])
+        self.centroids = centroids
+        self._fit_X = X[self.order]
+        self._fit_norms = np.einsum('ij,ij->i', self._fit_X, self._fit_X)
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        X = np.ascontiguousarray(X, dtype=float)
+        k = n_neighbors or self.n_neighbors
+        self.check_n_neighbors(k, len(self._fit_X))
+        n_probe = min(self.n_probe, len(self.centroids))
+
+        best_d = np.full((len(X), k), np.inf)
+        best_i = np.full((len(X), k), -1, dtype=np.int64)
+
+        probes = self.assign(X, self.centroids, n_probe)
+        for list_id in range(len(self.centroids)):
+            queries = np.flatnonzero((probes == list_id).any(axis=1))
+            start, stop = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if not len(queries) or stop == start:
+                continue
+            d = squared_distances(X[queries], self._fit_X[start:stop], self._fit_norms[start:stop])
+            cand_d = np.concatenate([best_d[queries], d], axis=1)
+            cand_i = np.concatenate([best_i[queries], np.broadcast_to(np.arange(start, stop), d.shape)], axis=1)
+            keep = np.argpartition(cand_d, k - 1, axis=1)[:, :k] if cand_d.shape[1] > k else \
+                np.arange(k)[np.newaxis, :].repeat(len(queries), axis=0)
+            best_d[queries] = np.take_along_axis(cand_d, keep, axis=1)
+            best_i[queries] = np.take_along_axis(cand_i, keep, axis=1)
+
+        # Not enough candidates in the probed lists - exact search for these queries
+        incomplete = np.flatnonzero((best_i < 0).any(axis=1))
+        for start in range(0, len(incomplete), self.batch_size):
+            queries = incomplete[start:start + self.batch_size]
+            d = squared_distances(X[queries], self._fit_X, self._fit_norms)
+            keep = np.argpartition(d, k - 1, axis=1)[:, :k]
+            best_d[queries] = np.take_along_axis(d, keep, axis=1)
+            best_i[queries] = keep
+
+        sort = np.argsort(best_d, axis=1, kind='stable')
+        indices = self.order[np.take_along_axis(best_i, sort, axis=1)]
+        if not return_distance:
+            return indices
+        return np.sqrt(np.take_along_axis(best_d, sort, axis=1)), indices
+
+
+NEIGHBOR_BACKENDS = {
+    'ivf': IVFNeighbors,
+}
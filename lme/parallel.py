@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+_worker_state = {}
+
+
+def effective_n_jobs(n_jobs):
+    """
+    Return the number of worker processes for n_jobs
+    :param n_jobs: int or None, None or 1 - no parallelism, negative - count back from the number of cores
+    :return: int
+    """
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def split_samples(n_samples, n_parts):
+    """
+    Split range(n_samples) into at most n_parts contiguous (start, stop) partitions
+    :param n_samples: int
+    :param n_parts: int
+    :return: list of tuples
+    """
+    bounds = np.linspace(0, n_samples, min(n_parts, n_samples) + 1).astype(int)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def _init_worker(func, kwargs):
+    _worker_state.update(func=func, kwargs=kwargs)
+
+
+def _attach(shm_name, shape, dtype):
+    if _worker_state.get('shm_name') == shm_name:
+        return _worker_state['values']
+    # The previous block is unlinked by the parent, its mapping is released before attaching the next one
+    _worker_state.pop('values', None)
+    if 'shm' in _worker_state:
+        _worker_state.pop('shm').close()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_state.update(shm_name=shm_name, shm=shm, values=np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _worker_state['values']
+
+
+def _run_partition(shm_name, shape, dtype, index, columns, start, stop):
+    block = pd.DataFrame(_attach(shm_name, shape, dtype)[start:stop], index=index, columns=columns, copy=False)
+    return _worker_state['func'](block, **_worker_state['kwargs'])
+
+
+class SamplePool(object):
+    def __init__(self, func, n_jobs, **kwargs):
+        """
+        Process pool applying func to partitions of samples of one or many DataFrames, see map_sample_partitions.
+        Worker processes are started on the first parallel map and receive func and kwargs once,
+        so blocks of a chunked run share the pool. Use as a context manager or call close()
+        :param func: picklable function, func(pd.DataFrame, **kwargs) -> pd.DataFrame with samples in index
+        :param n_jobs: int, number of worker processes, see effective_n_jobs
+        :param kwargs: read-only arguments for func
+        """
+        self.func = func
+        self.n_jobs = effective_n_jobs(n_jobs)
+        self.kwargs = kwargs
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def map(self, data):
+        """
+        Apply func to partitions of data and concatenate the results in the sample order.
+        Values of data are placed into shared memory once
+        :param data: pd.DataFrame, numeric, samples in rows
+        :return: pd.DataFrame
+        """
+        partitions = split_samples(len(data.index), self.n_jobs)
+        if self.n_jobs == 1 or len(partitions) < 2:
+            return self.func(data, **self.kwargs)
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker,
+                                                 initargs=(self.func, self.kwargs))
+
+        values = np.asarray(data.values)
+        if not np.issubdtype(values.dtype, np.floating):
+            values = values.astype(float)
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        try:
+            shared = np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)
+            shared[:] = values
+            del values
+
+            futures = [self._executor.submit(_run_partition, shm.name, shared.shape, shared.dtype,
+                                             data.index[start:stop], data.columns, start, stop)
+                       for start, stop in partitions]
+            results = [future.result() for future in futures]
+            del shared
+        finally:
+            shm.close()
+            shm.unlink()
+
+        return pd.concat(results)
+
+
+def map_sample_partitions(func, data, n_jobs, **kwargs):
+    """
+    Apply func to partitions of samples in a process pool and concatenate the results in the sample order.
+    Values of data are placed into shared memory once, func and kwargs are sent once per worker process.
+    Use SamplePool to score many DataFrames with the same worker processes
+    :param func: picklable function, func(pd.DataFrame, **kwargs) -> pd.DataFrame with samples in index
+    :param data: pd.DataFrame, numeric, samples in rows
+    :param n_jobs: int, number of worker processes, see effective_n_jobs
+    :param kwargs: read-only arguments for func
+    :return: pd.DataFrame
+    """
+    with SamplePool(func, n_jobs, **kwargs) as pool:
+        return pool.map(data)
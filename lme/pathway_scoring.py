@@ -1,27 +1,163 @@
+import functools
+from collections import OrderedDict
+
+from lme.alignment import index_positions
 from lme.utils import update_gene_names
 from lme.utils import read_dataset
+from lme.parallel import effective_n_jobs, map_sample_partitions
+from lme.profiling import instrument
+from lme.result_cache import content_hash
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
+PROGENY_COEFFICIENTS = Path(__file__).resolve().parent.parent.joinpath('databases', 'progeny_coefficients.tsv')
+
 
-def run_progeny(exp, sync_gene_names=True, prog_coeffs=None, **kwargs):
+def progeny_scores(exp, positions, coeffs, dtype=None):
     """
-    Runs PROGENy pathway scoring on provided expressions dataframe in python
+    Weighted sums of expressions by pathway coefficients
+    :param exp: pd.DataFrame; rows - samples, columns - Hugo Gene symbols
+    :param positions: np.ndarray, positions of coeffs genes in exp.columns
+    :param coeffs: pd.DataFrame; index - Hugo Gene symbols, columns - pathways
+    :param dtype: numpy float dtype of the product, None - float64
+    :return: pd.DataFrame; rows - samples, columns - pathways
+    """
+    dtype = dtype or np.float64
+    values = np.asarray(exp.values[:, positions], dtype=dtype) @ coeffs.values.astype(dtype)
+    return pd.DataFrame(values, index=exp.index, columns=coeffs.columns)
+
+
+class ProgenyScorer(object):
+    def __init__(self, prog_coeffs=None, sync_gene_names=True, max_cached=16, duplicates='first', **kwargs):
+        """
+        PROGENy pathway scoring with coefficient matrices cached per gene universe (expression columns).
+        Repeated scoring of batches with the same genes is a gather of coefficient genes and a matrix product.
+        :param prog_coeffs: pd.DataFrame, progeny_genes_coefficients;
+            columns - ['hugo_symbol', 'pathway', 'coefficient'], default - databases/progeny_coefficients.tsv
+        :param sync_gene_names: update gene names for old platforms
+        :param max_cached: int, number of gene universes to keep aligned coefficients for
+        :param duplicates: str, 'first', 'last' or 'error', expression column used for a duplicated gene symbol.
+            See lme.alignment.deduplicate_columns to aggregate duplicates before scoring
+        :param kwargs: passed to update_gene_names
+        """
+        if prog_coeffs is None:
+            prog_coeffs = read_dataset(PROGENY_COEFFICIENTS, index_col=None)
+        self.prog_coeffs = prog_coeffs
+        self.sync_gene_names = sync_gene_names
+        self.max_cached = max_cached
+        self.duplicates = duplicates
+        self.kwargs = kwargs
+        self._aligned = OrderedDict()
+        self._last_genes = (None, None)
+
+    def coefficients(self, genes):
+        """
+        Pivot coefficients to a genes x pathways matrix, gene names matched with genes
+        :param genes: pd.Index, expression gene names
+        :return: pd.DataFrame; index - Hugo Gene symbols, columns - pathways
+        """
+        prog_coeffs = self.prog_coeffs
+        if self.sync_gene_names:
+            matching_genes = update_gene_names(genes_old=prog_coeffs['hugo_symbol'],
+                                               genes_cur=genes, **self.kwargs)
+
+            prog_coeffs = prog_coeffs.assign(hugo_symbol=prog_coeffs.hugo_symbol.map(matching_genes))
+
+        return pd.pivot_table(prog_coeffs, index=['hugo_symbol'], columns=['pathway'], values='coefficient',
+                              aggfunc=sum, fill_value=0)
+
+    @instrument()
+    def align(self, genes):
+        """
+        Return positions of coefficient genes in genes and the coefficients of the genes found
+        Genes missing in the expressions do not contribute to scores (as with reindex(fill_value=0)),
+        only coefficient genes are gathered from the expressions
+        :param genes: pd.Index, expression gene names
+        :return: (np.ndarray, pd.DataFrame)
+        """
+        # pd.Index is immutable, the same object needs no rehashing
+        if self._last_genes[0] is genes:
+            key = self._last_genes[1]
+        else:
+            key = content_hash(pd.Index(genes))
+            if isinstance(genes, pd.Index):
+                self._last_genes = (genes, key)
+
+        if key in self._aligned:
+            self._aligned.move_to_end(key)
+            return self._aligned[key]
+
+        coeffs = self.coefficients(genes)
+        positions = index_positions(genes, coeffs.index, duplicates=self.duplicates)
+        found = positions >= 0
+        aligned = positions[found], coeffs[found]
+
+        self._aligned[key] = aligned
+        if len(self._aligned) > self.max_cached:
+            self._aligned.popitem(last=False)
+        return aligned
+
+    def fingerprint(self):
+        """
+        Content hash of the coefficients and gene name matching options, identifies cached scores.
+        Changes of the alias table itself are not tracked
+        :return: str
+        """
+        return content_hash(self.prog_coeffs, self.sync_gene_names, self.duplicates, sorted(self.kwargs))
+
+    @instrument()
+    def score(self, exp, n_jobs=None, dtype=None, result_cache=None):
+        """
+        :param exp: pd.DataFrame; rows - samples, columns - Hugo Gene symbols
+        :param n_jobs: int, number of processes to score partitions of samples in parallel, -1 - all cores
+        :param dtype: numpy float dtype of the product, None - float64
+        :param result_cache: lme.result_cache.ResultCache, score only samples without stored scores
+        :return: pd.DataFrame, progeny pathway scores; rows - samples, columns - pathways
+        """
+        if result_cache is not None:
+            namespace = f'progeny:{self.fingerprint()}:{np.dtype(dtype or np.float64).name}'
+            return result_cache.cached(namespace, exp, lambda missing: self.score(missing, n_jobs=n_jobs, dtype=dtype))
+
+        positions, coeffs = self.align(exp.columns)
+        if effective_n_jobs(n_jobs) > 1:
+            # Only coefficient genes are placed into shared memory
+            exp, positions = exp.iloc[:, positions], np.arange(len(positions))
+        return map_sample_partitions(progeny_scores, exp, n_jobs, positions=positions, coeffs=coeffs, dtype=dtype)
+
+
+@functools.lru_cache(maxsize=8)
+def get_progeny_scorer(coeffs_file=PROGENY_COEFFICIENTS, sync_gene_names=True, **kwargs):
+    """
+    Return ProgenyScorer for a coefficients file, created once per process
+    :param coeffs_file: str or Path, path to progeny coefficients table
     :param sync_gene_names: update gene names for old platforms
-    :param exp: pd.DataFrame; rows - Hugo Gene symbols, columns - samples
-    :param prog_coeffs: pd.DataFrame, progeny_genes_coefficients; index - HUGO gene symbols, columns - ['pathway', 'coefficient']
-    :returns progeny pathway scores dataframe
+    :param kwargs: passed to update_gene_names
+    :return: ProgenyScorer
     """
-    if prog_coeffs is None:
-        prog_coeffs = read_dataset(Path(__file__).resolve().parent.parent.joinpath('databases', 'progeny_coefficients.tsv'),
-                                   index_col=None)
-    if sync_gene_names:
-        matching_genes = update_gene_names(genes_old=prog_coeffs['hugo_symbol'],
-                                           genes_cur=exp.columns, **kwargs)
+    return ProgenyScorer(read_dataset(coeffs_file, index_col=None), sync_gene_names=sync_gene_names, **kwargs)
 
-        prog_coeffs = prog_coeffs.assign(hugo_symbol=prog_coeffs.hugo_symbol.map(matching_genes))
 
-    coeffs = pd.pivot_table(prog_coeffs, index=['hugo_symbol'], columns=['pathway'], values='coefficient',
-                            aggfunc=sum, fill_value=0)
+@instrument()
+def run_progeny(exp, sync_gene_names=True, prog_coeffs=None, n_jobs=None, dtype=None, result_cache=None, **kwargs):
+    """
+    Runs PROGENy pathway scoring on provided expressions dataframe in python
+    Default coefficients are read and aligned with exp genes once per process, see get_progeny_scorer
+    :param sync_gene_names: update gene names for old platforms. Aliases are resolved offline from
+        databases/hgnc_aliases.tsv (or alias_index=load_alias_index(path)), which is not bundled: without it gene
+        names are not converted and a warning is issued. Pass query_mygene=True to query mygene as before
+    :param exp: pd.DataFrame; rows - samples, columns - Hugo Gene symbols
+    :param prog_coeffs: pd.DataFrame, progeny_genes_coefficients;
+        columns - ['hugo_symbol', 'pathway', 'coefficient']
+    :param n_jobs: int, number of processes to score partitions of samples in parallel, -1 - all cores
+    :param dtype: numpy float dtype of scores, e.g. np.float32, None - float64
+    :param result_cache: lme.result_cache.ResultCache, score only samples without stored scores
+    :param kwargs: passed to update_gene_names (alias_index, query_mygene)
+    :returns progeny pathway scores dataframe
+    """
+    if prog_coeffs is None:
+        scorer = get_progeny_scorer(sync_gene_names=sync_gene_names, **kwargs)
+    else:
+        scorer = ProgenyScorer(prog_coeffs, sync_gene_names=sync_gene_names, **kwargs)
 
-    return exp.reindex(columns=coeffs.index, fill_value=0).dot(coeffs)
+    return scorer.score(exp, n_jobs=n_jobs, dtype=dtype, result_cache=result_cache)
@@ -0,0 +1,365 @@
+import argparse
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from lme.alignment import DUPLICATE_POLICIES, deduplicate_columns
+from lme.batch_effects import batch_effects, load_reference_signatures
+from lme.classification import KNeighborsClusterClassifier
+from lme.gene_sets import CompiledGeneSets
+from lme.pathway_scoring import ProgenyScorer
+from lme.profiling import PrometheusSink, profile
+from lme.result_cache import ResultCache
+from lme.stability import label_stability, replicate_proba, subsampled_ssgsea
+from lme.utils import (MedianScaler, median_scale, median_scale_array, read_dataset, ssgsea_formula_chunked,
+                       to_common_samples)
+
+ROOT = Path(__file__).resolve().parent.parent
+REFERENCE_COHORT_ANNOTATION = ROOT.joinpath('datasets', 'pan_cohort_annotation.tsv')
+REFERENCE_COHORT_EXPRESSION = ROOT.joinpath('datasets', 'pan_cohort_signatures.tsv.gz')
+GENE_SIGNATURES = ROOT.joinpath('databases', 'signatures.gmt')
+
+PROGENY_SELECTED = ['NFkB', 'p53', 'PI3K']
+SIGNATURES_SELECTED = [
+    'Lymphatic_endothelium',
+    'Angiogenesis',
+    'CAF',
+    'Fibroblastic_reticular_cells',
+    'Matrix',
+    'Matrix_remodeling',
+    'Granulocyte_traffic',
+    'Protumor_cytokines',
+    'Follicular_dendritic_cells',
+    'Macrophages',
+    'M1_signature',
+    'T_cell_traffic',
+    'MHCII',
+    'MHCI',
+    'Follicular_B_helper_T_cells',
+    'Treg',
+    'T_cells',
+    'Checkpoint_inhibition',
+    'NK_cells',
+    'B_cells_traffic',
+    'B_cells',
+    'Proliferation_rate']
+
+
+def build_reference_model(signatures=REFERENCE_COHORT_EXPRESSION, annotation=REFERENCE_COHORT_ANNOTATION, **kwargs):
+    """
+    Fit KNeighborsClusterClassifier on DLBCL samples of the reference cohort as in LME_Classification.ipynb
+    :param signatures: str or Path, reference cohort signatures, rows - signatures, columns - samples
+    :param annotation: str or Path, reference cohort annotation with Diagnosis and LME columns
+    :param kwargs: KNeighborsClusterClassifier parameters, default - norm=False, scale=False, clip=3, k=35
+    :return: KNeighborsClusterClassifier
+    """
+    cohort_signatures = read_dataset(signatures).T
+    cohort_ann = read_dataset(annotation)
+    cohort_ann = cohort_ann[(cohort_ann.Diagnosis == 'Diffuse_Large_B_Cell_Lymphoma') & (~cohort_ann.LME.isna())]
+
+    params = dict(norm=False, scale=False, clip=3, k=35)
+    params.update(kwargs)
+    return KNeighborsClusterClassifier(**params).fit(
+        *to_common_samples([cohort_signatures[SIGNATURES_SELECTED + PROGENY_SELECTED], cohort_ann.LME]))
+
+
+def is_log_scaled(expression):
+    """
+    Check if expressions look log2 transformed: mean of every gene is within [0, 18]
+    :param expression: pd.DataFrame, rows - samples, columns - genes
+    :return: bool
+    """
+    return all(0 <= mean <= 18 for mean in expression.mean())
+
+
+def write_table(df, path, fmt='tsv'):
+    """
+    :param df: pd.DataFrame
+    :param path: Path without extension
+    :param fmt: str, 'tsv' or 'parquet'
+    :return: Path of the written file
+    """
+    if fmt == 'tsv':
+        path = path.with_name(path.name + '.tsv')
+        df.to_csv(path, sep='\t')
+    elif fmt == 'parquet':
+        path = path.with_name(path.name + '.parquet')
+        df.to_parquet(path)
+    else:
+        raise Exception(f'Unknown output format: {fmt}')
+    return path
+
+
+def dataset_name(path):
+    """
+    File name without .gz/.tsv/.txt/.csv extensions
+    """
+    name = Path(path).name
+    for suffix in ['.gz', '.tsv', '.txt', '.csv']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+class LMEPipeline(object):
+    def __init__(self, model=None, gene_sets=GENE_SIGNATURES, clip=3, chunksize=1000, n_jobs=None, scaler=None,
+                 dtype=None, result_cache=None, batch_gate=None, duplicate_genes='first', stability=None, **kwargs):
+        """
+        LME classification of expression cohorts: log2 check, ssGSEA and PROGENy scoring, median scaling and
+        KNN classification. The model, gene sets and PROGENy coefficients are loaded once and reused for all cohorts
+        :param model: KNeighborsClusterClassifier, path to a model saved with KNeighborsClusterClassifier.save
+            or None to fit on the reference cohort
+        :param gene_sets: str or Path to .gmt file, dict of GeneSet or CompiledGeneSets
+        :param clip: float, median_scale clip value
+        :param chunksize: int, number of samples scored at once
+        :param n_jobs: int, number of processes for scoring
+        :param scaler: MedianScaler or path to statistics saved with MedianScaler.save. Signatures are scaled
+            by these reference statistics instead of statistics of each cohort, so single samples can be classified
+        :param dtype: numpy float dtype of expressions, scores and the reference model (if fitted here),
+            e.g. np.float32 to halve memory, None - float64
+        :param result_cache: lme.result_cache.ResultCache or path to its database. Scores (and predictions with
+            a reference scaler) of samples seen before are read from it instead of being computed
+        :param batch_gate: dict of lme.batch_effects.batch_effects thresholds (max_ks, alpha, max_shifted),
+            {} - default thresholds. Files are checked against the reference cohort and classified only if they pass
+        :param duplicate_genes: str, policy for duplicated gene symbols of expressions: 'first', 'last', 'sum', 'mean',
+            'max' or 'error', see lme.alignment.deduplicate_columns
+        :param stability: dict of LMEPipeline.stability parameters (n_replicates, fraction, noise, random_state),
+            {} - defaults. run_file also writes label stability of every sample
+        :param kwargs: passed to ProgenyScorer
+        """
+        if model is None:
+            model = build_reference_model(dtype=dtype or np.float64)
+        elif not isinstance(model, KNeighborsClusterClassifier):
+            model = KNeighborsClusterClassifier.load(model)
+        self.model = model
+
+        if isinstance(gene_sets, (str, Path)):
+            gene_sets = CompiledGeneSets.from_gmt(gene_sets)
+        self.gene_sets = CompiledGeneSets.from_gene_sets(gene_sets)
+        self.progeny = ProgenyScorer(**kwargs)
+        self.clip = clip
+        self.chunksize = chunksize
+        self.n_jobs = n_jobs
+        self.dtype = dtype
+        if isinstance(scaler, (str, Path)):
+            scaler = MedianScaler.load(scaler)
+        self.scaler = scaler
+        if isinstance(result_cache, (str, Path)):
+            result_cache = ResultCache(result_cache)
+        self.result_cache = result_cache
+        self.batch_gate = batch_gate
+        self.duplicate_genes = duplicate_genes
+        self.stability_params = stability
+        self._reference_signatures = None
+
+    def prepare(self, expression, log_transform='auto'):
+        """
+        Resolve duplicated genes and log2 transform expressions
+        :param expression: pd.DataFrame, rows - samples, columns - genes
+        :param log_transform: 'auto' - log2 transform if is_log_scaled is False, bool - transform or not
+        :return: pd.DataFrame
+        """
+        expression = deduplicate_columns(expression, self.duplicate_genes)
+        if log_transform == 'auto':
+            log_transform = not is_log_scaled(expression)
+        if log_transform:
+            expression = np.log2(1 + expression)
+        return expression
+
+    def score(self, expression, log_transform='auto'):
+        """
+        :param expression: pd.DataFrame, rows - samples, columns - genes
+        :param log_transform: see prepare
+        :return: pd.DataFrame, ssGSEA and PROGENy scores; rows - samples, columns - signatures
+        """
+        expression = self.prepare(expression, log_transform)
+        ssgsea_scores = ssgsea_formula_chunked(expression, self.gene_sets, chunksize=self.chunksize,
+                                               n_jobs=self.n_jobs, dtype=self.dtype, result_cache=self.result_cache)
+        progeny_scores = self.progeny.score(expression, n_jobs=self.n_jobs, dtype=self.dtype,
+                                            result_cache=self.result_cache)
+        return pd.concat([ssgsea_scores, progeny_scores], axis=1)
+
+    def scale(self, signatures):
+        """
+        Median scale signatures by the reference scaler if provided, otherwise by their own statistics
+        :param signatures: pd.DataFrame, rows - samples, columns - signatures
+        :return: pd.DataFrame
+        """
+        if self.scaler is None and len(signatures) < 2:
+            raise Exception(f'{len(signatures)} sample(s) can not be median scaled by their own statistics, '
+                            'pass a reference scaler (MedianScaler.save file, --scaler in python -m lme)')
+        return median_scale(signatures, self.clip, scaler=self.scaler, dtype=self.dtype)
+
+    def classify(self, signatures):
+        """
+        :param signatures: pd.DataFrame, rows - samples, columns - signatures
+        :return: (pd.Series, pd.DataFrame), LME labels and probabilities
+        """
+        signatures_scaled = self.scale(signatures)
+        # Without a reference scaler scaled signatures change with the cohort and are rarely found in the cache
+        labels, proba = self.model.predict_with_proba(
+            signatures_scaled[self.model.X.columns],
+            result_cache=self.result_cache if self.scaler is not None else None)
+        return labels.rename('LME'), proba
+
+    def run(self, expression):
+        """
+        :param expression: pd.DataFrame, rows - samples, columns - genes
+        :return: (pd.Series, pd.DataFrame, pd.DataFrame), LME labels, probabilities and signature scores
+        """
+        signatures = self.score(expression)
+        labels, proba = self.classify(signatures)
+        return labels, proba, signatures
+
+    def stability(self, expression, labels=None, n_replicates=100, fraction=0.8, noise=0.1, random_state=42,
+                  log_transform='auto'):
+        """
+        Label stability over replicates with subsampled gene set members (ssGSEA) and noise added to scaled
+        signatures, see lme.stability. PROGENy scores are not perturbed. Replicates are scaled as the cohort
+        and classified with one neighbors query, split between n_jobs processes
+        :param expression: pd.DataFrame, rows - samples, columns - genes
+        :param labels: pd.Series, LME labels of the unperturbed data, default - computed with score and classify
+        :param n_replicates: int
+        :param fraction: float, probability to keep each gene set member in a replicate
+        :param noise: float, standard deviation of gaussian noise in units of the scaled signatures (MAD)
+        :param random_state: int
+        :return: pd.DataFrame, rows - samples, see lme.stability.label_stability
+        """
+        expression = self.prepare(expression, log_transform)
+        if labels is None:
+            labels = self.classify(self.score(expression, log_transform=False))[0]
+
+        dtype = self.dtype or np.float64
+        ssgsea_scores = subsampled_ssgsea(expression, self.gene_sets, n_replicates=n_replicates, fraction=fraction,
+                                          dtype=dtype, random_state=random_state)
+        progeny_scores = self.progeny.score(expression, n_jobs=self.n_jobs, dtype=self.dtype,
+                                            result_cache=self.result_cache)
+        signatures = np.concatenate([ssgsea_scores, np.broadcast_to(
+            progeny_scores.values.astype(dtype), (n_replicates, ) + progeny_scores.shape)], axis=2)
+        columns = pd.Index(list(self.gene_sets.keys()) + list(progeny_scores.columns))
+        signatures = signatures[:, :, columns.get_indexer(self.model.X.columns)]
+
+        if self.scaler is not None:
+            self.scaler.transform_array(signatures, self.model.X.columns, self.clip)
+        else:
+            median_scale_array(signatures, self.clip)
+        if noise:
+            signatures += np.random.default_rng(random_state).normal(scale=noise, size=signatures.shape)
+
+        proba = replicate_proba(self.model, signatures, n_jobs=self.n_jobs)
+        return label_stability(proba, self.model.model.classes_, index=expression.index,
+                               labels=labels.reindex(expression.index))
+
+    def check_batch(self, signatures, batches=None):
+        """
+        Compare signature distributions with the reference cohort, see lme.batch_effects.batch_effects
+        :param signatures: pd.DataFrame, rows - samples, columns - signatures
+        :param batches: pd.Series of batch labels, None - one batch
+        :return: pd.DataFrame, gating table; rows - batches
+        """
+        if self._reference_signatures is None:
+            self._reference_signatures = load_reference_signatures()
+        return batch_effects(signatures, batches=batches, reference=self._reference_signatures,
+                             **(self.batch_gate or {}))
+
+    def run_file(self, path, output_dir, fmt='tsv'):
+        """
+        Classify an expression file and write <name>_labels, <name>_proba and <name>_scores tables.
+        With batch_gate also <name>_batch_effects; files which do not pass are not classified.
+        With stability also <name>_stability
+        :param path: str or Path, expression table, rows - samples, columns - genes
+        :param output_dir: str or Path
+        :param fmt: str, 'tsv' or 'parquet'
+        :return: list of written paths
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        name = dataset_name(path)
+
+        expression = read_dataset(path, dtype=self.dtype)
+        signatures = self.score(expression)
+        written = [write_table(signatures, output_dir / f'{name}_scores', fmt)]
+        if self.batch_gate is not None:
+            gate = self.check_batch(signatures)
+            written.append(write_table(gate, output_dir / f'{name}_batch_effects', fmt))
+            if not gate.passed.all():
+                warnings.warn('{} is not classified, shifted signatures: {}'.format(
+                    path, ', '.join(gate.shifted_signatures)))
+                return written
+
+        labels, proba = self.classify(signatures)
+        written = [write_table(labels.to_frame(), output_dir / f'{name}_labels', fmt),
+                   write_table(proba, output_dir / f'{name}_proba', fmt)] + written
+        if self.stability_params is not None:
+            stability = self.stability(expression, labels=labels, **self.stability_params)
+            written.append(write_table(stability, output_dir / f'{name}_stability', fmt))
+        return written
+
+    def run_many(self, paths, output_dir, fmt='tsv', pattern='*.tsv*'):
+        """
+        Classify expression files one by one, directories are expanded with pattern
+        :return: dict {input path -> list of written paths}
+        """
+        written = {}
+        for path in expand_paths(paths, pattern):
+            written[path] = self.run_file(path, output_dir, fmt=fmt)
+        return written
+
+
+def expand_paths(paths, pattern='*.tsv*'):
+    """
+    :param paths: list of files and directories
+    :param pattern: glob pattern for files in directories
+    :return: list of Path
+    """
+    expanded = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            expanded.extend(sorted(p for p in path.glob(pattern) if p.is_file()))
+        else:
+            expanded.append(path)
+    return expanded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lme', description='LME classification of expression cohorts')
+    parser.add_argument('inputs', nargs='+', help='expression files (rows - samples, columns - genes) or directories')
+    parser.add_argument('-o', '--output-dir', required=True)
+    parser.add_argument('--model', help='saved model directory; fitted on the reference cohort and saved if missing')
+    parser.add_argument('--gene-sets', default=str(GENE_SIGNATURES), help='.gmt file')
+    parser.add_argument('--format', default='tsv', choices=['tsv', 'parquet'])
+    parser.add_argument('--pattern', default='*.tsv*', help='file pattern for input directories')
+    parser.add_argument('--chunksize', type=int, default=1000)
+    parser.add_argument('--n-jobs', type=int, default=None)
+    parser.add_argument('--scaler', help='reference median/MAD statistics saved with MedianScaler.save')
+    parser.add_argument('--dtype', default=None, choices=['float32', 'float64'])
+    parser.add_argument('--result-cache', help='SQLite file with per-sample scores reused by later runs')
+    parser.add_argument('--batch-gate', action='store_true',
+                        help='classify only files without batch effects against the reference cohort')
+    parser.add_argument('--max-ks', type=float, default=0.2, help='batch gate KS statistic threshold')
+    parser.add_argument('--duplicate-genes', default='first', choices=DUPLICATE_POLICIES,
+                        help='policy for duplicated gene symbols')
+    parser.add_argument('--stability', type=int, default=None, metavar='N',
+                        help='write label stability over N perturbed replicates')
+    parser.add_argument('--profile', help='write stage timings to this file in Prometheus text format')
+    args = parser.parse_args(argv)
+
+    with profile(*([PrometheusSink(args.profile)] if args.profile else [])):
+        model = None
+        if args.model is not None:
+            if Path(args.model).exists():
+                model = KNeighborsClusterClassifier.load(args.model)
+            else:
+                model = build_reference_model(dtype=args.dtype or np.float64)
+                model.save(args.model)
+
+        pipeline = LMEPipeline(model=model, gene_sets=args.gene_sets, chunksize=args.chunksize, n_jobs=args.n_jobs,
+                               scaler=args.scaler, dtype=args.dtype, result_cache=args.result_cache,
+                               batch_gate={'max_ks': args.max_ks} if args.batch_gate else None,
+                               duplicate_genes=args.duplicate_genes,
+                               stability={'n_replicates': args.stability} if args.stability else None)
+        for path, written in pipeline.run_many(args.inputs, args.output_dir, fmt=args.format,
+                                               pattern=args.pattern).items():
+            print('{}: {}'.format(path, ', '.join(map(str, written))))
@@ -1,12 +1,9 @@
 import copy
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import seaborn as sns
-import umap
-from umap import UMAP
 
+from lme.qc import DEFAULT_COMPONENTS, qc_embedding
 from lme.utils import item_series, to_common_samples
 
 
@@ -23,6 +20,8 @@ def axis_net(x, y, title='', x_len=4, y_len=4, title_y=1, gridspec_kw=None):
     :param title_y: absolute y position for suptitle
     :return: axs.flat, numpy.flatiter object which consists of axes (for further plots)
     """
+    import matplotlib.pyplot as plt
+
     if x == y == 1:
         fig, ax = plt.subplots(figsize=(x * x_len, y * y_len))
         af = ax
@@ -41,6 +40,9 @@ def patch_plot(patches, ax=None, order='sort', w=0.25, h=0, legend_right=True,
     :param patches: dict {value -> color}
     :return:
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     cur_patches = pd.Series(patches)
 
     if order == 'sort':
@@ -79,6 +81,8 @@ def axis_matras(ys, title='', x_len=8, title_y=1, sharex=True):
     :param title_y: absolute y position for suptitle
     :return: axs.flat, numpy.flatiter object which consists of axes (for further plots)
     """
+    import matplotlib.pyplot as plt
+
     fig, axs = plt.subplots(len(ys), 1, figsize=(x_len, np.sum(ys)), gridspec_kw={'height_ratios': ys}, sharex=sharex)
     fig.suptitle(title, y=title_y)
 
@@ -113,6 +117,8 @@ def line_annotation_plot(color_vector, ax=None, nan_color='#ffffff', offset=0, h
     :param offset:
     :return:
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     if ax is None:
         _, ax = plt.subplots(figsize=(max(len(color_vector) / 15.0, 6), 0.5))
@@ -162,6 +168,8 @@ def vector_pie_plot(data, ax=None, figsize=(4, 4), title='', palette=None, displ
     :param order: list, order to display groups
     :return: matplotlib axis
     """
+    import matplotlib.pyplot as plt
+
     if ax is None:
         _, ax = plt.subplots(figsize=figsize)
 
@@ -225,7 +233,13 @@ def lin_colors(factors_vector, cmap='default', sort=True, min_v=0, max_v=1, lins
 
 def pca_plot(data, grouping=None, order=(), n_components=2, ax=None, palette=None,
              alpha=1, random_state=42, s=20, figsize=(5, 5), title='',
-             legend='in',pad=20, **kwargs):
+             legend='in',pad=20, embedding=None, **kwargs):
+    """
+    Scatter of the first two principal components. The embedding is fitted with randomized PCA
+    and cached (see lme.qc.qc_embedding), so repeated plots of the same data reuse it
+    :param embedding: lme.qc.QCEmbedding fitted on data, default - qc_embedding(data)
+    :param kwargs: scatter parameters (linewidth, marker, edgecolor) and qc_embedding parameters
+    """
     kwargs_scatter = dict()
     kwargs_scatter['linewidth'] = kwargs.pop('linewidth', 0)
     kwargs_scatter['marker'] = kwargs.pop('marker', 'o')
@@ -248,17 +262,13 @@ def pca_plot(data, grouping=None, order=(), n_components=2, ax=None, palette=Non
         cur_palette = copy.copy(palette)
 
     if ax is None:
+        import matplotlib.pyplot as plt
         _, ax = plt.subplots(figsize=figsize)
 
-    # Get model and transform
-    n_components = min(n_components, len(c_data.columns))
-    from sklearn.decomposition import PCA
-    model = PCA(n_components=n_components, random_state=random_state, **kwargs)
-
-    data_tr = pd.DataFrame(model.fit_transform(c_data), index=c_data.index)
-
-    label_1 = 'PCA 1 component {}% variance explained'.format(int(model.explained_variance_ratio_[0] * 100))
-    label_2 = 'PCA 2 component {}% variance explained'.format(int(model.explained_variance_ratio_[1] * 100))
+    if embedding is None:
+        embedding = qc_embedding(c_data, n_components=max(n_components, DEFAULT_COMPONENTS),
+                                 random_state=random_state, **kwargs)
+    data_tr = embedding.pca(2).set_axis([0, 1], axis=1)
 
     kwargs_scatter = kwargs_scatter or {}
     for group in group_order:
@@ -279,7 +289,14 @@ def pca_plot(data, grouping=None, order=(), n_components=2, ax=None, palette=Non
 
 def umap_plot(data, grouping=None, order=(), n_components=30, ax=None, palette=None,
              alpha=1, random_state=42, s=20, figsize=(5, 5), title='',
-             legend='in',pad =10, **kwargs):
+             legend='in',pad =10, embedding=None, umap_kwargs=None, **kwargs):
+    """
+    UMAP of n_components principal components. PCA and UMAP are fitted once per data and cached
+    (see lme.qc.qc_embedding)
+    :param embedding: lme.qc.QCEmbedding fitted on data, default - qc_embedding(data)
+    :param umap_kwargs: dict, umap.UMAP parameters
+    :param kwargs: scatter parameters (linewidth, marker, edgecolor) and qc_embedding parameters
+    """
     kwargs_scatter = dict()
     kwargs_scatter['linewidth'] = kwargs.pop('linewidth', 0)
     kwargs_scatter['marker'] = kwargs.pop('marker', 'o')
@@ -302,23 +319,17 @@ def umap_plot(data, grouping=None, order=(), n_components=30, ax=None, palette=N
         cur_palette = copy.copy(palette)
 
     if ax is None:
+        import matplotlib.pyplot as plt
         _, ax = plt.subplots(figsize=figsize)
 
-    # Get model and transform
-    n_components = min(n_components, len(c_data.columns))
-    from sklearn.decomposition import PCA
-    model = PCA(n_components= n_components, random_state=random_state, **kwargs)
-    reducer = umap.UMAP()
-    
-    data_tmp = pd.DataFrame(model.fit_transform(c_data), index=c_data.index)
-
-    
-    data_tr = pd.DataFrame(reducer.fit_transform(data_tmp), index=c_data.index)
-    
+    if embedding is None:
+        embedding = qc_embedding(c_data, n_components=n_components, random_state=random_state, **kwargs)
+    data_tr = embedding.umap(random_state=random_state, **(umap_kwargs or {}))
+
     kwargs_scatter = kwargs_scatter or {}
     for group in group_order:
         samples = list(c_grouping[c_grouping == group].index)
-        ax.scatter(data_tr[0], data_tr[1], color=cur_palette[group], s=s, alpha=alpha,
+        ax.scatter(data_tr[0][samples], data_tr[1][samples], color=cur_palette[group], s=s, alpha=alpha,
                    label=str(group), **kwargs_scatter)
 
     if legend == 'out':
@@ -0,0 +1,233 @@
+"""
+Per-stage timing of lme functions. Instrumented functions (read_dataset, ssgsea_formula, ssgsea_score, run_progeny,
+update_gene_names, median_scale, classifier fit/predict) report duration, input shape and memory delta to the
+registered sinks. Without sinks an instrumented call costs one extra function call.
+
+    from lme.profiling import MemorySink, profile
+    with profile(MemorySink()) as (sink, ):
+        LMEPipeline().run(expression)
+    print(sink.summary())
+"""
+import contextlib
+import functools
+import logging
+import os
+import resource
+import threading
+import time
+from collections import defaultdict, namedtuple
+from pathlib import Path
+
+import pandas as pd
+
+StageRecord = namedtuple('StageRecord', ['name', 'parent', 'seconds', 'shape', 'memory_delta_mb', 'error'])
+
+_sinks = []
+_local = threading.local()
+_PAGE_SIZE_MB = os.sysconf('SC_PAGE_SIZE') / 2 ** 20 if hasattr(os, 'sysconf') else None
+
+
+def rss_mb():
+    """
+    Current resident set size, peak resident set size where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * _PAGE_SIZE_MB
+    except (OSError, TypeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def input_shape(args):
+    """
+    Shape of the first argument with shape (DataFrame, array) or length of the first sized one
+    """
+    for arg in args:
+        shape = getattr(arg, 'shape', None)
+        if shape is not None:
+            return tuple(shape)
+    for arg in args:
+        if not isinstance(arg, (str, bytes)) and hasattr(arg, '__len__'):
+            return len(arg),
+    return None
+
+
+def add_sink(sink):
+    """
+    :param sink: object with record(StageRecord) method
+    """
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+    if hasattr(sink, 'flush'):
+        sink.flush()
+
+
+def enabled():
+    return bool(_sinks)
+
+
+@contextlib.contextmanager
+def profile(*sinks):
+    """
+    Register sinks for the duration of the block
+    :return: tuple of sinks
+    """
+    for sink in sinks:
+        add_sink(sink)
+    try:
+        yield sinks
+    finally:
+        for sink in sinks:
+            remove_sink(sink)
+
+
+@contextlib.contextmanager
+def stage(name, data=None):
+    """
+    Measure a block of code, e.g. with stage('ranking', data): ...
+    :param name: str
+    :param data: input of the stage to report its shape
+    """
+    if not _sinks:
+        yield
+        return
+    with _measure(name, input_shape([data]) if data is not None else None):
+        yield
+
+
+@contextlib.contextmanager
+def _measure(name, shape):
+    stack = _local.__dict__.setdefault('stack', [])
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    measured = {'shape': shape}
+    error = None
+    memory_start = rss_mb()
+    start = time.perf_counter()
+    try:
+        yield measured
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        record = StageRecord(name, parent, seconds, measured['shape'], rss_mb() - memory_start, error)
+        for sink in list(_sinks):
+            sink.record(record)
+
+
+def instrument(name=None):
+    """
+    Decorator reporting calls of a function as stages. The shape is taken from its arguments
+    or from the result if no argument has one (e.g. read_dataset)
+    :param name: str, default - function qualified name
+    """
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with _measure(stage_name, input_shape(args)) as measured:
+                result = func(*args, **kwargs)
+                if measured['shape'] is None:
+                    measured['shape'] = input_shape([result])
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+class MemorySink(object):
+    def __init__(self):
+        """
+        Collect records in memory
+        """
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def to_frame(self):
+        return pd.DataFrame(self.records, columns=StageRecord._fields)
+
+    def summary(self):
+        """
+        :return: pd.DataFrame, calls, total, mean and max seconds and total memory delta by stage
+        """
+        df = self.to_frame()
+        summary = df.groupby('name').agg(calls=('seconds', 'size'), total_seconds=('seconds', 'sum'),
+                                         mean_seconds=('seconds', 'mean'), max_seconds=('seconds', 'max'),
+                                         memory_delta_mb=('memory_delta_mb', 'sum'))
+        return summary.sort_values('total_seconds', ascending=False)
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+
+class LoggingSink(object):
+    def __init__(self, logger=None, level=logging.INFO):
+        """
+        Log every record
+        :param logger: logging.Logger, default - 'lme.profiling' logger
+        :param level: int, logging level
+        """
+        self.logger = logger or logging.getLogger('lme.profiling')
+        self.level = level
+
+    def record(self, record):
+        self.logger.log(self.level, '%s%s: %.4f s, shape %s, memory %+.1f MB%s', record.name,
+                        f' (in {record.parent})' if record.parent else '', record.seconds, record.shape,
+                        record.memory_delta_mb, f', failed with {record.error}' if record.error else '')
+
+
+class PrometheusSink(object):
+    def __init__(self, path, prefix='lme'):
+        """
+        Accumulate counters by stage and write them in Prometheus text format on flush,
+        e.g. for the node exporter textfile collector
+        :param path: str or Path, .prom file
+        :param prefix: str, metric name prefix
+        """
+        self.path = Path(path)
+        self.prefix = prefix
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.memory = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def record(self, record):
+        with self._lock:
+            self.calls[record.name] += 1
+            self.errors[record.name] += record.error is not None
+            self.seconds[record.name] += record.seconds
+            self.memory[record.name] += record.memory_delta_mb
+
+    def text(self):
+        metrics = [('stage_calls_total', 'counter', 'Number of calls', self.calls),
+                   ('stage_errors_total', 'counter', 'Number of failed calls', self.errors),
+                   ('stage_seconds_total', 'counter', 'Total duration in seconds', self.seconds),
+                   ('stage_memory_delta_megabytes', 'gauge', 'Total resident memory change', self.memory)]
+        lines = []
+        for metric, kind, description, values in metrics:
+            name = f'{self.prefix}_{metric}'
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            lines += [f'{name}{{stage="{stage_name}"}} {value}' for stage_name, value in sorted(values.items())]
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        with self._lock:
+            text = self.text()
+        temporary = self.path.with_name(self.path.name + '.tmp')
+        temporary.write_text(text)
+        os.replace(temporary, self.path)
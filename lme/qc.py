@@ -0,0 +1,146 @@
+"""
+Batch and outlier QC of expression cohorts: PCA embedding fitted once (randomized or incremental PCA),
+UMAP on top of it and Mahalanobis outlier scores. Embeddings are cached by data content, so pca_plot and
+umap_plot calls on the same matrix reuse one fit.
+
+    report = qc_report(expression)
+    report[report.outlier]
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from lme.result_cache import content_hash
+
+DEFAULT_COMPONENTS = 30
+OUTLIER_COMPONENTS = 5
+
+_embeddings = OrderedDict()
+MAX_CACHED = 4
+
+
+class QCEmbedding(object):
+    def __init__(self, n_components=DEFAULT_COMPONENTS, method='randomized', batch_size=None, n_iter=2,
+                 random_state=42):
+        """
+        :param n_components: int, number of principal components, limited by the data shape
+        :param method: str, 'randomized' - PCA with randomized SVD,
+            'incremental' - IncrementalPCA fitted by batches of samples (bounded memory)
+        :param batch_size: int, samples per batch for 'incremental'
+        :param n_iter: int, power iterations of randomized SVD; leading components of expression data
+            converge in a few iterations
+        :param random_state: int
+        """
+        self.n_components = n_components
+        self.method = method
+        self.batch_size = batch_size
+        self.n_iter = n_iter
+        self.random_state = random_state
+        self.model = None
+        self.scores = None
+        self._umap = {}
+
+    def fit(self, data):
+        """
+        :param data: pd.DataFrame, rows - samples, columns - genes
+        :return: self
+        """
+        from sklearn.decomposition import IncrementalPCA, PCA
+
+        n_components = min(self.n_components, *data.shape)
+        if self.method == 'randomized':
+            model = PCA(n_components=n_components, svd_solver='randomized', iterated_power=self.n_iter,
+                        random_state=self.random_state)
+        elif self.method == 'incremental':
+            model = IncrementalPCA(n_components=n_components, batch_size=self.batch_size)
+        else:
+            raise Exception(f'Unknown PCA method: {self.method}')
+
+        values = np.asarray(data.values, dtype=np.float64)
+        self.model = model
+        self.scores = pd.DataFrame(model.fit_transform(values), index=data.index,
+                                   columns=[f'PC{i + 1}' for i in range(n_components)])
+        self._umap = {}
+        return self
+
+    @property
+    def explained_variance_ratio(self):
+        return pd.Series(self.model.explained_variance_ratio_, index=self.scores.columns)
+
+    def pca(self, n_components=2):
+        """
+        :return: pd.DataFrame, first principal components; rows - samples
+        """
+        return self.scores.iloc[:, :n_components]
+
+    def umap(self, random_state=42, **kwargs):
+        """
+        UMAP of the principal components, fitted once per parameters
+        :param kwargs: umap.UMAP parameters
+        :return: pd.DataFrame, rows - samples, columns - 0, 1
+        """
+        key = content_hash(random_state, kwargs)
+        if key not in self._umap:
+            from umap import UMAP
+            reducer = UMAP(random_state=random_state, **kwargs)
+            self._umap[key] = pd.DataFrame(reducer.fit_transform(self.scores.values), index=self.scores.index)
+        return self._umap[key]
+
+    def mahalanobis(self, n_components=OUTLIER_COMPONENTS):
+        """
+        Squared Mahalanobis distances of samples to the cohort center in the space of the first principal components.
+        Components are uncorrelated, so the distance is a sum of squared scores divided by component variances
+        :param n_components: int, number of leading components, None - all
+        :return: pd.Series
+        """
+        scores = self.scores.values[:, :n_components]
+        variance = scores.var(axis=0, ddof=1)
+        variance[variance == 0] = np.inf
+        return pd.Series(((scores - scores.mean(axis=0)) ** 2 / variance).sum(axis=1), index=self.scores.index,
+                         name='mahalanobis')
+
+    def outlier_pvalues(self, n_components=OUTLIER_COMPONENTS):
+        """
+        :return: pd.Series, chi-squared p-values of squared Mahalanobis distances, see mahalanobis
+        """
+        from scipy.stats import chi2
+        df = self.scores.iloc[:, :n_components].shape[1]
+        return pd.Series(chi2.sf(self.mahalanobis(n_components).values, df=df), index=self.scores.index,
+                         name='p_value')
+
+
+def qc_embedding(data, n_components=DEFAULT_COMPONENTS, method='randomized', batch_size=None, n_iter=2,
+                 random_state=42):
+    """
+    Return a fitted QCEmbedding, cached by data content and parameters
+    :param data: pd.DataFrame, rows - samples, columns - genes
+    :return: QCEmbedding
+    """
+    key = content_hash(data, data.columns, n_components, method, batch_size, n_iter, random_state)
+    if key in _embeddings:
+        _embeddings.move_to_end(key)
+        return _embeddings[key]
+
+    embedding = QCEmbedding(n_components=n_components, method=method, batch_size=batch_size, n_iter=n_iter,
+                            random_state=random_state).fit(data)
+    _embeddings[key] = embedding
+    if len(_embeddings) > MAX_CACHED:
+        _embeddings.popitem(last=False)
+    return embedding
+
+
+def qc_report(data, n_components=DEFAULT_COMPONENTS, alpha=0.001, outlier_components=OUTLIER_COMPONENTS,
+              method='randomized', **kwargs):
+    """
+    Headless QC table
+    :param data: pd.DataFrame, rows - samples, columns - genes
+    :param alpha: float, p-value threshold of outliers
+    :param outlier_components: int, number of leading components for Mahalanobis distances
+    :return: pd.DataFrame, rows - samples, columns - PC1, PC2, mahalanobis, p_value, outlier
+    """
+    embedding = qc_embedding(data, n_components=n_components, method=method, **kwargs)
+    report = pd.concat([embedding.pca(2), embedding.mahalanobis(outlier_components),
+                        embedding.outlier_pvalues(outlier_components)], axis=1)
+    report['outlier'] = report.p_value < alpha
+    return report
@@ -0,0 +1,78 @@
+import numpy as np
+
+BLOCK_ELEMENTS = 1 << 22
+
+
+def rank_rows(x, method='max', columns=None, out=None, block_size=None):
+    """
+    Rank values within each row, as pandas rank(axis=1, method=method, na_option='bottom'):
+    1 - the smallest value, equal values get the minimum or maximum rank of their group,
+    NaN are ranked last and tie with each other.
+    Rows are ranked in blocks, so temporary memory is limited by the block, not by x
+
+    :param x: 2D np.ndarray, e.g. samples x genes
+    :param method: str, 'min' or 'max'
+    :param columns: array of column positions to return ranks for, default - all columns
+    :param out: np.ndarray to write ranks to, shape (rows, number of returned columns), float dtype
+    :param block_size: int, number of rows ranked at once, default - about 4M elements per block
+    :return: np.ndarray, ranks
+    """
+    if method not in ('min', 'max'):
+        raise Exception(f'Unknown rank method: {method}')
+    x = np.asarray(x)
+    n_rows, n_columns = x.shape
+    n_out = n_columns if columns is None else len(columns)
+    if out is None:
+        out = np.empty((n_rows, n_out), dtype=np.float64)
+    elif out.shape != (n_rows, n_out):
+        raise Exception(f'Output shape {out.shape} does not match ({n_rows}, {n_out})')
+    if n_columns == 0:
+        return out
+
+    block_size = block_size or max(1, BLOCK_ELEMENTS // n_columns)
+    if columns is not None:
+        return rank_selected_columns(x, method, columns, out, block_size)
+
+    positions = np.arange(n_columns)
+    for start in range(0, n_rows, block_size):
+        block = x[start:start + block_size]
+
+        # Order within a tie group does not matter, so the sort does not need to be stable
+        order = np.argsort(block, axis=1)
+        ordered = np.take_along_axis(block, order, axis=1)
+        # new_group[:, i] - ordered[:, i] differs from ordered[:, i - 1]; NaN are sorted last and equal to each other
+        new_group = np.ones(ordered.shape, dtype=bool)
+        same = ordered[:, 1:] == ordered[:, :-1]
+        if np.issubdtype(ordered.dtype, np.floating):
+            same |= np.isnan(ordered[:, 1:]) & np.isnan(ordered[:, :-1])
+        new_group[:, 1:] = ~same
+
+        if method == 'min':
+            ordered_ranks = np.maximum.accumulate(np.where(new_group, positions, 0), axis=1) + 1
+        else:
+            group_end = np.ones(ordered.shape, dtype=bool)
+            group_end[:, :-1] = new_group[:, 1:]
+            ordered_ranks = np.minimum.accumulate(np.where(group_end, positions, n_columns)[:, ::-1],
+                                                  axis=1)[:, ::-1] + 1
+
+        np.put_along_axis(out[start:start + len(block)], order, ordered_ranks, axis=1)
+    return out
+
+
+def rank_selected_columns(x, method, columns, out, block_size):
+    """
+    Ranks of a few columns: the rank of a value is the number of smaller ('min', plus one) or not greater ('max')
+    values in its row, found by binary search in the sorted row. NaN are sorted last and searchsorted places them
+    after all numbers, so NaN get the same ranks as with na_option='bottom'
+    """
+    side = 'left' if method == 'min' else 'right'
+    offset = 1 if method == 'min' else 0
+    ordered = np.empty((min(block_size, len(x)), x.shape[1]), dtype=x.dtype)
+    for start in range(0, len(x), block_size):
+        block = x[start:start + block_size]
+        block_ordered = ordered[:len(block)]
+        block_ordered[:] = block
+        block_ordered.sort(axis=1)
+        for i in range(len(block)):
+            out[start + i] = np.searchsorted(block_ordered[i], block[i, columns], side=side) + offset
+    return out
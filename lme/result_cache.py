@@ -0,0 +1,171 @@
+"""
+Per-sample result store for repeated scoring of growing cohorts. Results are keyed by a hash of the sample's
+expression vector (with gene names) within a namespace that identifies the computation: stage, gene set,
+coefficient or model fingerprint and dtype. Only new or changed samples are computed.
+
+    cache = ResultCache('lme_results.sqlite')
+    scores = ssgsea_formula(expression, gene_sets, result_cache=cache)
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+QUERY_BATCH = 500
+
+
+def content_hash(*parts):
+    """
+    sha1 of strings, numpy arrays, pandas objects and JSON-serializable values
+    :return: str
+    """
+    sha1 = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (pd.Index, pd.Series, pd.DataFrame)):
+            part = pd.util.hash_pandas_object(part, index=not isinstance(part, pd.Index)).values
+        if isinstance(part, np.ndarray):
+            if part.dtype.kind in 'OUS':
+                part = part.astype(str)
+            sha1.update(str((part.dtype.str, part.shape)).encode())
+            sha1.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, bytes):
+            sha1.update(part)
+        else:
+            sha1.update(json.dumps(part, sort_keys=True, default=str).encode())
+        sha1.update(b'\0')
+    return sha1.hexdigest()
+
+
+def sample_hashes(data, block_size=1024):
+    """
+    Hash of every sample: gene names and expression values as float64
+    :param data: pd.DataFrame, rows - samples, columns - genes
+    :return: np.ndarray of str
+    """
+    genes = content_hash(data.columns).encode()
+    hashes = []
+    for start in range(0, len(data), block_size):
+        block = np.ascontiguousarray(data.values[start:start + block_size], dtype=np.float64)
+        for row in block:
+            sha1 = hashlib.sha1(genes)
+            sha1.update(row.tobytes())
+            hashes.append(sha1.hexdigest())
+    return np.array(hashes, dtype=object)
+
+
+class ResultCache(object):
+    def __init__(self, path):
+        """
+        SQLite store of per-sample results
+        :param path: str or Path, database file, ':memory:' - in-memory store
+        """
+        self.path = str(path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS namespaces '
+                                     '(namespace TEXT PRIMARY KEY, columns TEXT, dtype TEXT)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS results (namespace TEXT, sample TEXT, value BLOB, '
+                                     'PRIMARY KEY (namespace, sample)) WITHOUT ROWID')
+
+    def columns(self, namespace):
+        """
+        :return: (list of result columns, np.dtype) of a namespace or None if it is empty
+        """
+        row = self._connection.execute('SELECT columns, dtype FROM namespaces WHERE namespace = ?',
+                                       (namespace, )).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), np.dtype(row[1])
+
+    def get(self, namespace, keys):
+        """
+        :param namespace: str
+        :param keys: list of sample hashes
+        :return: dict {sample hash -> np.ndarray of results}
+        """
+        described = self.columns(namespace)
+        if described is None:
+            return {}
+        dtype = described[1]
+
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), QUERY_BATCH):
+            batch = keys[start:start + QUERY_BATCH]
+            rows = self._connection.execute(
+                'SELECT sample, value FROM results WHERE namespace = ? AND sample IN ({})'.format(
+                    ','.join('?' * len(batch))), [namespace, *batch])
+            found.update((sample, np.frombuffer(value, dtype=dtype)) for sample, value in rows)
+        return found
+
+    def put(self, namespace, columns, keys, values):
+        """
+        :param namespace: str
+        :param columns: list of result columns
+        :param keys: list of sample hashes
+        :param values: 2D np.ndarray, rows - samples, columns - results
+        """
+        values = np.ascontiguousarray(values)
+        described = self.columns(namespace)
+        if described is not None and (described[0] != [str(c) for c in columns] or described[1] != values.dtype):
+            raise Exception(f'Results do not match columns or dtype stored in {namespace}')
+        with self._connection:
+            self._connection.execute('INSERT OR IGNORE INTO namespaces VALUES (?, ?, ?)',
+                                     (namespace, json.dumps([str(c) for c in columns]), values.dtype.str))
+            self._connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                                         ((namespace, key, row.tobytes()) for key, row in zip(keys, values)))
+
+    def cached(self, namespace, data, compute):
+        """
+        Return results for all samples of data, computing only samples not found in the store
+        :param namespace: str, identifies the computation, see content_hash
+        :param data: pd.DataFrame, rows - samples, columns - genes (features)
+        :param compute: function pd.DataFrame -> pd.DataFrame, results for a subset of samples (rows)
+        :return: pd.DataFrame, rows - samples of data, columns - result columns
+        """
+        keys = sample_hashes(data)
+        with self._lock:
+            found = self.get(namespace, set(keys))
+            missing = np.array([key not in found for key in keys], dtype=bool)
+            self.hits += int((~missing).sum())
+            self.misses += int(missing.sum())
+
+            computed = None
+            if missing.any():
+                computed = compute(data[missing])
+                self.put(namespace, computed.columns, keys[missing], computed.values)
+                # Computed columns keep their original labels (e.g. classes), the store keeps strings
+                columns = list(computed.columns)
+            elif len(keys):
+                columns = self.columns(namespace)[0]
+            else:
+                return compute(data)
+
+        values = np.empty((len(keys), len(columns)),
+                          dtype=computed.values.dtype if computed is not None else self.columns(namespace)[1])
+        for i in np.flatnonzero(~missing):
+            values[i] = found[keys[i]]
+        if computed is not None:
+            values[missing] = computed.values
+        return pd.DataFrame(values, index=data.index, columns=columns)
+
+    def clear(self, namespace=None):
+        """
+        Remove results of a namespace or all results
+        """
+        with self._lock, self._connection:
+            if namespace is None:
+                self._connection.execute('DELETE FROM results')
+                self._connection.execute('DELETE FROM namespaces')
+            else:
+                self._connection.execute('DELETE FROM results WHERE namespace = ?', (namespace, ))
+                self._connection.execute('DELETE FROM namespaces WHERE namespace = ?', (namespace, ))
+
+    def close(self):
+        self._connection.close()
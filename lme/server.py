@@ -0,0 +1,284 @@
+"""
+LME classification service. The pipeline (KNN model, compiled gene sets, PROGENy coefficients) stays in memory,
+concurrent requests are grouped into micro-batches which are scored and classified in one pass.
+
+    python -m lme.server --port 8080 --model lme_model
+    python -m lme.server --unix-socket /tmp/lme.sock
+
+POST /classify with JSON {"samples": {sample_id: {gene: expression}}} returns
+{"labels": {sample_id: label}, "proba": {sample_id: {label: probability}}, "timings": {stage: seconds},
+"batch_size": number of samples classified in the same pass}. With a reference scaler (--scaler) every sample is
+scaled by the stored statistics and single samples can be classified. Without it expressions of a request are median
+scaled together, so a request has to contain several samples. GET /stats returns request counters and mean stage
+timings.
+"""
+import argparse
+import asyncio
+import json
+import time
+import urllib.request
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from lme.pipeline import LMEPipeline, is_log_scaled
+
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+class ClassificationRequest(object):
+    def __init__(self, expression, future):
+        self.expression = expression
+        self.future = future
+
+
+class LMEServer(object):
+    def __init__(self, pipeline=None, max_batch_size=256, max_delay=0.01):
+        """
+        :param pipeline: LMEPipeline, default - LMEPipeline()
+        :param max_batch_size: int, maximum number of samples in a micro-batch
+        :param max_delay: float, seconds to wait for more requests after the first one of a batch
+        """
+        self.pipeline = pipeline if pipeline is not None else LMEPipeline()
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.stats = {'requests': 0, 'samples': 0, 'batches': 0, 'errors': 0}
+        self.stage_seconds = defaultdict(float)
+        self._queue = None
+        self._batcher = None
+        self._server = None
+
+    def process_batch(self, expressions):
+        """
+        Score and classify expressions of several requests in one pass
+        Requests are checked separately: a request which fails scoring or scaling gets its own error and
+        the rest of the batch is classified
+        :param expressions: list of pd.DataFrame, rows - samples, columns - genes
+        :return: (list of (pd.Series, pd.DataFrame) labels and probabilities or Exception for each request,
+            dict of stage timings)
+        """
+        timings = {}
+        results = [None] * len(expressions)
+
+        start = time.perf_counter()
+        expressions = [expression if is_log_scaled(expression) else np.log2(1 + expression)
+                       for expression in expressions]
+        # Requests with the same genes are scored together
+        groups = []
+        for i, expression in enumerate(expressions):
+            for columns, members in groups:
+                if columns.equals(expression.columns):
+                    members.append(i)
+                    break
+            else:
+                groups.append((expression.columns, [i]))
+        timings['prepare'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        signatures = [None] * len(expressions)
+        for _, members in groups:
+            try:
+                scores = self.pipeline.score(pd.concat([expressions[i] for i in members]), log_transform=False)
+            except Exception:
+                # Find the failing requests of the group
+                for i in members:
+                    try:
+                        signatures[i] = self.pipeline.score(expressions[i], log_transform=False)
+                    except Exception as e:
+                        results[i] = e
+                continue
+            offset = 0
+            for i in members:
+                signatures[i] = scores.iloc[offset:offset + len(expressions[i])]
+                offset += len(expressions[i])
+        timings['score'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        columns = self.pipeline.model.X.columns
+        scaled = [None] * len(expressions)
+        for i, request_signatures in enumerate(signatures):
+            if results[i] is not None:
+                continue
+            try:
+                request_scaled = self.pipeline.scale(request_signatures)[columns]
+                if not np.isfinite(request_scaled.values).all():
+                    raise ValueError('Scaled signatures are not finite, a request without a reference scaler '
+                                     'needs several samples with varying expressions')
+                scaled[i] = request_scaled
+            except Exception as e:
+                results[i] = e
+        timings['scale'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        valid = [i for i in range(len(expressions)) if results[i] is None]
+        if valid:
+            labels, proba = self.pipeline.model.predict_with_proba(pd.concat([scaled[i] for i in valid]))
+            offset = 0
+            for i in valid:
+                n = len(expressions[i])
+                results[i] = labels.iloc[offset:offset + n], proba.iloc[offset:offset + n]
+                offset += n
+        timings['classify'] = time.perf_counter() - start
+        return results, timings
+
+    async def classify(self, expression):
+        """
+        Queue expressions for the next micro-batch
+        :param expression: pd.DataFrame, rows - samples, columns - genes
+        :return: (pd.Series, pd.DataFrame, dict, int) labels, probabilities, stage timings and batch size
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(ClassificationRequest(expression, future))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            n_samples = len(batch[0].expression)
+            deadline = loop.time() + self.max_delay
+            while n_samples < self.max_batch_size:
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                batch.append(request)
+                n_samples += len(request.expression)
+
+            try:
+                results, timings = await loop.run_in_executor(
+                    None, self.process_batch, [request.expression for request in batch])
+            except Exception as e:
+                self.stats['errors'] += len(batch)
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            self.stats['batches'] += 1
+            self.stats['samples'] += n_samples
+            for stage, seconds in timings.items():
+                self.stage_seconds[stage] += seconds
+            for request, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.stats['errors'] += 1
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result((*result, timings, n_samples))
+
+    async def handle_classify(self, body):
+        start = time.perf_counter()
+        samples = json.loads(body)['samples']
+        expression = pd.DataFrame.from_dict(samples, orient='index').astype(float)
+        if self.pipeline.scaler is None and len(expression) < 2:
+            raise ValueError('Without a reference scaler samples of a request are median scaled together, '
+                             'at least 2 samples are required')
+        parse_seconds = time.perf_counter() - start
+
+        labels, proba, timings, batch_size = await self.classify(expression)
+        self.stats['requests'] += 1
+        return {'labels': labels.to_dict(), 'proba': proba.to_dict(orient='index'),
+                'timings': {'parse': parse_seconds, **timings, 'total': time.perf_counter() - start},
+                'batch_size': batch_size}
+
+    def handle_stats(self):
+        batches = max(self.stats['batches'], 1)
+        return {**self.stats, 'mean_batch_seconds': {stage: seconds / batches
+                                                     for stage, seconds in self.stage_seconds.items()}}
+
+    async def handle_connection(self, reader, writer):
+        status, response = 200, None
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            method, path = request_line[0], request_line[1]
+            if method == 'POST' and path == '/classify':
+                response = await self.handle_classify(body)
+            elif method == 'GET' and path == '/stats':
+                response = self.handle_stats()
+            else:
+                status, response = 404, {'error': f'{method} {path} is not supported'}
+        except (KeyError, IndexError, ValueError) as e:
+            status, response = 400, {'error': repr(e)}
+        except Exception as e:
+            status, response = 500, {'error': repr(e)}
+
+        payload = json.dumps(response).encode()
+        writer.write(f'HTTP/1.1 {status} {HTTP_STATUS[status]}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    async def start(self, host='127.0.0.1', port=0, unix_socket=None):
+        """
+        Start serving in the running event loop
+        :param host: str
+        :param port: int, 0 - any free port
+        :param unix_socket: str, path of a Unix socket to listen on instead of host and port
+        :return: asyncio.Server
+        """
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batches())
+        if unix_socket is not None:
+            self._server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+        else:
+            self._server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+        return self._server
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+
+
+def classify_remote(expression, url='http://127.0.0.1:8080', timeout=60):
+    """
+    Send expressions to a running LMEServer
+    :param expression: pd.DataFrame, rows - samples, columns - genes
+    :param url: str, server address
+    :return: dict, server response
+    """
+    body = json.dumps({'samples': expression.to_dict(orient='index')}).encode()
+    request = urllib.request.Request(url.rstrip('/') + '/classify', data=body,
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lme.server', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix-socket')
+    parser.add_argument('--model', help='model directory saved with KNeighborsClusterClassifier.save')
+    parser.add_argument('--scaler', help='reference median/MAD statistics saved with MedianScaler.save')
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--max-delay', type=float, default=0.01, help='seconds')
+    args = parser.parse_args(argv)
+
+    server = LMEServer(LMEPipeline(model=args.model, scaler=args.scaler), max_batch_size=args.max_batch_size,
+                       max_delay=args.max_delay)
+
+    async def serve():
+        await server.start(host=args.host, port=args.port, unix_socket=args.unix_socket)
+        print('Serving on {}'.format(args.unix_socket or f'http://{args.host}:{server.port}'))
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Confidence of LME calls from perturbed replicates of signatures. Replicates of all samples are stacked into one
+array and classified with a single neighbors query:
+- gene subsampling: ssGSEA scores with a random fraction of every gene set's members, expressions are ranked once
+  and each replicate only changes the membership matrix;
+- noise: gaussian noise added to the median scaled signatures.
+Label stability is the fraction of replicates that keep the label, entropy measures how replicate labels spread
+over classes.
+
+    stability = LMEPipeline().stability(expression, n_replicates=100, noise=0.1)
+    stability[stability.stability < 0.8]
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from lme.gene_sets import CompiledGeneSets
+from lme.parallel import effective_n_jobs, map_sample_partitions
+from lme.profiling import instrument, stage
+from lme.ranking import rank_rows
+from lme.utils import ssgsea_member_scores
+
+
+@instrument()
+def subsampled_ssgsea(data, gene_sets, n_replicates=100, fraction=0.8, rank_method='max', dtype=None,
+                      random_state=42):
+    """
+    ssgsea_formula scores of replicates with randomly subsampled gene set members
+    Member sets of all replicates are stacked into one sparse matrix, scored with one product.
+    With fraction=1 every replicate equals ssgsea_formula(data, gene_sets)
+    :param data: pd.DataFrame, rows - samples, columns - genes (unique)
+    :param gene_sets: dict, keys - processes, values - GeneSet, or CompiledGeneSets
+    :param n_replicates: int
+    :param fraction: float, probability to keep each member gene in a replicate
+    :param rank_method: str, 'min' or 'max'
+    :param dtype: numpy float dtype of ranks and scores, default - float64
+    :param random_state: int
+    :return: np.ndarray, replicates x samples x gene sets
+    """
+    dtype = dtype or np.float64
+    gene_sets = CompiledGeneSets.from_gene_sets(gene_sets)
+    membership, _ = gene_sets.align(data.columns)
+    used = np.flatnonzero(membership.getnnz(axis=0))
+
+    with stage('ssgsea_formula.rank', data):
+        member_ranks = rank_rows(data.values, rank_method, columns=used,
+                                 out=np.empty((len(data), len(used)), dtype=dtype))
+
+    rng = np.random.default_rng(random_state)
+    stacked = sparse.vstack([membership[:, used]] * n_replicates, format='csr')
+    stacked.data = (rng.random(stacked.nnz) < fraction).astype(dtype)
+    stacked.eliminate_zeros()
+    n_common = np.asarray(stacked.sum(axis=1)).ravel().astype(int)
+
+    scores = ssgsea_member_scores(member_ranks, stacked, n_common, len(data.columns), dtype=dtype)
+    return scores.reshape(len(data), n_replicates, len(gene_sets.names)).transpose(1, 0, 2)
+
+
+def _preprocessed_proba(block, model):
+    return pd.DataFrame(model.preprocessed_proba(block.values), index=block.index)
+
+
+@instrument()
+def replicate_proba(model, replicates, n_jobs=None):
+    """
+    Class probabilities of all replicates with one neighbors query
+    :param model: fitted KNeighborsClusterClassifier
+    :param replicates: np.ndarray, replicates x samples x features (columns of model.X)
+    :param n_jobs: int, number of processes to split the stacked replicates between, -1 - all cores
+    :return: np.ndarray, replicates x samples x classes (model.model.classes_)
+    """
+    n_replicates, n_samples = replicates.shape[:2]
+    x = model.preprocess_replicates(replicates)
+    if effective_n_jobs(n_jobs) > 1:
+        proba = map_sample_partitions(_preprocessed_proba, pd.DataFrame(x, copy=False), n_jobs, model=model).values
+    else:
+        proba = model.preprocessed_proba(x)
+    return proba.reshape(n_replicates, n_samples, -1)
+
+
+def label_stability(proba, classes, index=None, labels=None):
+    """
+    Per sample summary of replicate calls
+    :param proba: np.ndarray, replicates x samples x classes, see replicate_proba
+    :param classes: np.ndarray, class labels of the last proba axis
+    :param index: sample ids
+    :param labels: pd.Series or array, calls on unperturbed data, default - the most frequent replicate label
+    :return: pd.DataFrame, rows - samples, columns - label, stability (fraction of replicates with the label),
+        entropy (of replicate label frequencies, bits), mean_proba (mean probability of the label),
+        and replicate label frequencies of every class
+    """
+    classes = np.asarray(classes)
+    n_replicates, n_samples, n_classes = proba.shape
+    # As in predict_with_proba the first of equally probable classes is selected
+    calls = proba.argmax(axis=2)
+    frequencies = np.zeros((n_samples, n_classes))
+    np.add.at(frequencies, (np.arange(n_samples)[np.newaxis, :], calls), 1)
+    frequencies /= n_replicates
+
+    if labels is None:
+        codes = frequencies.argmax(axis=1)
+    else:
+        codes = pd.Index(classes).get_indexer(np.asarray(labels))
+        if (codes < 0).any():
+            raise Exception('Labels do not match classes')
+    rows = np.arange(n_samples)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        entropy = -np.where(frequencies > 0, frequencies * np.log2(frequencies), 0).sum(axis=1)
+    summary = pd.DataFrame({'label': classes[codes], 'stability': frequencies[rows, codes], 'entropy': entropy,
+                            'mean_proba': proba[:, rows, codes].mean(axis=0)}, index=index)
+    return pd.concat([summary, pd.DataFrame(frequencies, index=summary.index, columns=classes)], axis=1)
@@ -0,0 +1,254 @@
+"""
+Cohort-wide median and MAD (mean absolute deviation from the mean, as in median_scale) of data that does not fit
+in memory. Statistics are accumulated over chunks in passes with mergeable states:
+1. count, sum, minimum and maximum of every column;
+2. a histogram between the minimum and the maximum and the sum of absolute deviations from the mean.
+   The median is interpolated within its histogram bin (error below range / bins);
+3. (exact) values of the bins holding the middle order statistics, the median is exact.
+Partial states of workers are merged with merge.
+
+    scaler = cohort_statistics(['part1.tsv.gz', 'part2.tsv.gz'], n_jobs=2)
+    scaled = median_scale(expression, clip=3, scaler=scaler)
+"""
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from lme.parallel import effective_n_jobs
+from lme.utils import MedianScaler, read_dataset_chunks
+
+
+class StreamingMedianMAD(object):
+    MOMENTS, HISTOGRAM, EXACT, DONE = range(4)
+
+    def __init__(self, bins=4096):
+        """
+        :param bins: int, histogram bins per column
+        """
+        self.bins = bins
+        self.phase = self.MOMENTS
+        self.columns = None
+        self.count = None
+        self.sum = None
+        self.min = None
+        self.max = None
+        self.abs_deviation = None
+        self.histogram = None
+        self.candidates = None
+        self._targets = None
+        self._below = None
+
+    def _values(self, chunk):
+        if self.columns is None:
+            self.columns = pd.Index(chunk.columns)
+            n = len(self.columns)
+            self.count = np.zeros(n, dtype=np.int64)
+            self.sum = np.zeros(n)
+            self.min = np.full(n, np.inf)
+            self.max = np.full(n, -np.inf)
+        elif not self.columns.equals(chunk.columns):
+            chunk = chunk.reindex(columns=self.columns)
+        return np.asarray(chunk.values, dtype=np.float64)
+
+    def _bin_codes(self, values):
+        width = (self.max - self.min) / self.bins
+        width[width == 0] = 1
+        codes = np.floor((values - self.min) / width)
+        return np.clip(np.nan_to_num(codes, nan=0), 0, self.bins - 1).astype(np.int64)
+
+    def update(self, chunk):
+        """
+        Add a chunk of samples to the current pass
+        :param chunk: pd.DataFrame, rows - samples, columns - features
+        :return: self
+        """
+        values = self._values(chunk)
+        known = ~np.isnan(values)
+        if self.phase == self.MOMENTS:
+            self.count += known.sum(axis=0)
+            self.sum += np.nansum(values, axis=0)
+            if len(values):
+                self.min = np.fmin(self.min, np.nanmin(np.where(known, values, np.inf), axis=0))
+                self.max = np.fmax(self.max, np.nanmax(np.where(known, values, -np.inf), axis=0))
+        elif self.phase == self.HISTOGRAM:
+            self.abs_deviation += np.nansum(np.abs(values - self.mean_values()), axis=0)
+            codes = self._bin_codes(values) + np.arange(len(self.columns)) * self.bins
+            self.histogram += np.bincount(codes[known], minlength=self.histogram.size).reshape(self.histogram.shape)
+        elif self.phase == self.EXACT:
+            codes = self._bin_codes(values)
+            selected = known & (codes >= self._targets[0]) & (codes <= self._targets[1])
+            for i in np.flatnonzero(selected.any(axis=0)):
+                self.candidates[i].append(values[selected[:, i], i])
+        else:
+            raise Exception('All passes are done')
+        return self
+
+    def merge(self, other):
+        """
+        Add the state of another accumulator of the same pass (e.g. fitted by a worker on other samples)
+        :param other: StreamingMedianMAD
+        :return: self
+        """
+        if other.columns is None:
+            return self
+        if self.columns is None:
+            self.__dict__.update(copy.deepcopy(other.__dict__))
+            return self
+        if other.phase != self.phase or not self.columns.equals(other.columns):
+            raise Exception('Accumulators of different passes or columns can not be merged')
+
+        if self.phase == self.MOMENTS:
+            self.count += other.count
+            self.sum += other.sum
+            self.min = np.fmin(self.min, other.min)
+            self.max = np.fmax(self.max, other.max)
+        elif self.phase == self.HISTOGRAM:
+            self.abs_deviation += other.abs_deviation
+            self.histogram += other.histogram
+        elif self.phase == self.EXACT:
+            for mine, theirs in zip(self.candidates, other.candidates):
+                mine.extend(theirs)
+        return self
+
+    def next_pass(self):
+        """
+        Finish the current pass, the same data is to be passed through update again
+        :return: self
+        """
+        if self.columns is None:
+            raise Exception('No samples were accumulated')
+        if self.phase == self.MOMENTS:
+            self.abs_deviation = np.zeros(len(self.columns))
+            self.histogram = np.zeros((len(self.columns), self.bins), dtype=np.int64)
+        elif self.phase == self.HISTOGRAM:
+            lower, upper = self.middle_positions()
+            cumulative = self.histogram.cumsum(axis=1)
+            rows = np.arange(len(self.columns))
+            self._targets = (np.minimum((cumulative <= lower[:, np.newaxis]).sum(axis=1), self.bins - 1),
+                             np.minimum((cumulative <= upper[:, np.newaxis]).sum(axis=1), self.bins - 1))
+            # Values below the first target bin
+            self._below = np.where(self._targets[0] > 0, cumulative[rows, np.maximum(self._targets[0] - 1, 0)], 0)
+            self.candidates = [[] for _ in self.columns]
+        self.phase += 1
+        return self
+
+    def middle_positions(self):
+        """
+        Zero-based positions of the middle order statistics (equal for odd counts)
+        """
+        return (self.count - 1) // 2, self.count // 2
+
+    def mean_values(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.sum / np.maximum(self.count, 1), np.nan)
+
+    def mean(self):
+        return pd.Series(self.mean_values(), index=self.columns)
+
+    def mad(self):
+        """
+        Mean absolute deviation from the mean, available after the histogram pass
+        """
+        if self.phase <= self.HISTOGRAM:
+            raise Exception('MAD is available after the histogram pass')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.Series(np.where(self.count > 0, self.abs_deviation / np.maximum(self.count, 1), np.nan),
+                             index=self.columns)
+
+    def median(self):
+        """
+        Exact median after the exact pass, otherwise interpolated within the histogram bin
+        """
+        if self.phase <= self.HISTOGRAM:
+            raise Exception('Median is available after the histogram pass')
+        if self.phase == self.DONE:
+            return pd.Series([self._exact_median(i) for i in range(len(self.columns))], index=self.columns)
+
+        lower, upper = self.middle_positions()
+        return pd.Series((self._interpolate(lower) + self._interpolate(upper)) / 2, index=self.columns)
+
+    def _interpolate(self, positions):
+        cumulative = self.histogram.cumsum(axis=1)
+        rows = np.arange(len(self.columns))
+        codes = np.minimum((cumulative <= positions[:, np.newaxis]).sum(axis=1), self.bins - 1)
+        below = np.where(codes > 0, cumulative[rows, np.maximum(codes - 1, 0)], 0)
+        in_bin = np.maximum(self.histogram[rows, codes], 1)
+        width = (self.max - self.min) / self.bins
+        with np.errstate(invalid='ignore'):
+            values = self.min + width * (codes + (positions - below + 0.5) / in_bin)
+        return np.where(self.count > 0, np.clip(values, self.min, self.max), np.nan)
+
+    def _exact_median(self, i):
+        if self.count[i] == 0:
+            return np.nan
+        values = np.sort(np.concatenate(self.candidates[i]))
+        lower, upper = (self.count[i] - 1) // 2 - self._below[i], self.count[i] // 2 - self._below[i]
+        return (values[lower] + values[upper]) / 2
+
+    def to_scaler(self, update_rate=None):
+        """
+        :return: MedianScaler with the accumulated statistics
+        """
+        return MedianScaler(self.median(), self.mad(), self.mean(), update_rate=update_rate)
+
+
+def iter_partition(partition, chunksize=1000):
+    """
+    :param partition: str or Path to a table, pd.DataFrame or function returning an iterable of pd.DataFrame
+    :return: iterable of pd.DataFrame chunks, rows - samples
+    """
+    if isinstance(partition, (str, Path)):
+        return read_dataset_chunks(partition, chunksize=chunksize)
+    if isinstance(partition, pd.DataFrame):
+        return (partition.iloc[i:i + chunksize] for i in range(0, len(partition), chunksize))
+    return partition()
+
+
+def accumulate_partition(state, partition, chunksize=1000):
+    """
+    Run the current pass of a copy of state over one partition
+    :return: StreamingMedianMAD with the partition state
+    """
+    state = copy.deepcopy(state)
+    for chunk in iter_partition(partition, chunksize):
+        state.update(chunk)
+    return state
+
+
+def cohort_statistics(partitions, exact=True, bins=4096, chunksize=1000, n_jobs=None):
+    """
+    Median, MAD and mean of every feature over data read by chunks
+    :param partitions: str or Path to a table (rows - samples), pd.DataFrame, function returning an iterable of
+        pd.DataFrame chunks, or a list of those. Every partition is read once per pass (2 or 3 times)
+    :param exact: bool, exact median with one more pass, otherwise interpolated within a histogram bin
+    :param bins: int, histogram bins per feature
+    :param chunksize: int, samples read at once
+    :param n_jobs: int, number of processes to accumulate partitions in parallel
+    :return: MedianScaler
+    """
+    if not isinstance(partitions, (list, tuple)):
+        partitions = [partitions]
+    n_jobs = min(effective_n_jobs(n_jobs), len(partitions))
+
+    state = StreamingMedianMAD(bins=bins)
+    passes = 3 if exact else 2
+    executor = ProcessPoolExecutor(n_jobs) if n_jobs > 1 else None
+    try:
+        for _ in range(passes):
+            arguments = [state] * len(partitions), partitions, [chunksize] * len(partitions)
+            if executor is not None:
+                states = list(executor.map(accumulate_partition, *arguments))
+            else:
+                states = list(map(accumulate_partition, *arguments))
+            state = states[0]
+            for partial in states[1:]:
+                state.merge(partial)
+            state.next_pass()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return state.to_scaler()
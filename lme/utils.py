@@ -1,22 +1,16 @@
 import warnings
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
-
-class GeneSet(object):
-    def __init__(self, name, descr, genes):
-        self.name = name
-        self.descr = descr
-        self.genes = set(genes)
-        self.genes_ordered = list(genes)
-
-    def __str__(self):
-        s = ','.join(self.genes)
-        return f'{self.name} ({self.descr}): {s}'
-
-    def __repr__(self):
-        return self.__str__()
+from lme.alignment import common_index, index_positions, take
+from lme.aliases import load_alias_index
+from lme.gene_sets import CompiledGeneSets, GeneSet
+from lme.io import NA_VALUES, as_dtype, read_table
+from lme.parallel import SamplePool, effective_n_jobs, map_sample_partitions
+from lme.profiling import instrument, stage
+from lme.ranking import rank_rows
 
 
 def read_gene_sets(gmt_file):
@@ -38,6 +32,7 @@ def read_gene_sets(gmt_file):
     return gene_sets
 
 
+@instrument()
 def ssgsea_score(ranks, genes):
     common_genes = list(set(genes).intersection(set(ranks.index)))
     if not len(common_genes):
@@ -46,33 +41,282 @@ def ssgsea_score(ranks, genes):
     return (sranks ** 1.25).sum() / (sranks ** 0.25).sum() - (len(ranks.index) - len(common_genes) + 1) / 2
 
 
-def ssgsea_formula(data, gene_sets, rank_method='max'):
+def ssgsea_member_scores(member_ranks, membership, n_common, n_genes, dtype=np.float64):
+    """
+    ssGSEA formula on ranks of gene set members
+
+    :param member_ranks: np.ndarray, ranks of member genes, rows - samples, columns - genes
+    :param membership: scipy.sparse matrix, gene sets x member genes
+    :param n_common: np.ndarray, number of genes of each gene set found among all ranked genes
+    :param n_genes: int, number of ranked genes
+    :param dtype: numpy float dtype of rank powers and scores
+    :return: np.ndarray, rows - samples, columns - gene sets
+    """
+    membership = membership.astype(dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (membership @ member_ranks.T ** 1.25) / (membership @ member_ranks.T ** 0.25)
+    scores -= ((n_genes - n_common[:, np.newaxis] + 1) / 2).astype(dtype)
+    scores[n_common == 0] = 0
+    return scores.T
+
+
+@instrument()
+def ssgsea_formula(data, gene_sets, rank_method='max', engine='matrix', n_jobs=None, dtype=None,
+                   result_cache=None, pool=None):
     """
     Return DataFrame with ssgsea scores
     Only overlapping genes will be analyzed
 
-    :param data: pd.DataFrame, DataFrame with samples in columns and variables in rows
-    :param gene_sets: dict, keys - processes, values - bioreactor.gsea.GeneSet
+    :param data: pd.DataFrame, DataFrame with samples in rows and genes in columns
+    :param gene_sets: dict, keys - processes, values - GeneSet, or CompiledGeneSets
     :param rank_method: str, 'min' or 'max'.
-    :return: pd.DataFrame, ssgsea scores, index - genesets, columns - patients
+    :param engine: str, 'matrix' - rank with rank_rows and score all gene sets with one membership matrix product,
+        only ranks of gene set members are kept; 'loop' - rank with pandas and score gene sets one by one
+        with ssgsea_score
+    :param n_jobs: int, number of processes to score partitions of samples in parallel, -1 - all cores
+    :param dtype: numpy float dtype of rank powers and scores for the 'matrix' engine, default - float64
+    :param result_cache: lme.result_cache.ResultCache, score only samples without stored scores
+    :param pool: lme.parallel.SamplePool of ssgsea_formula with the same arguments, used instead of n_jobs
+        to reuse worker processes across calls
+    :return: pd.DataFrame, ssgsea scores, index - patients, columns - genesets
     """
+    if result_cache is not None:
+        gene_sets = CompiledGeneSets.from_gene_sets(gene_sets)
+        namespace = f'ssgsea:{gene_sets.fingerprint()}:{rank_method}:{np.dtype(dtype or np.float64).name}'
+        return result_cache.cached(namespace, data, lambda missing: ssgsea_formula(
+            missing, gene_sets, rank_method=rank_method, engine=engine, n_jobs=n_jobs, dtype=dtype, pool=pool))
+
+    if pool is not None:
+        return pool.map(data)
+    if effective_n_jobs(n_jobs) > 1:
+        return map_sample_partitions(ssgsea_formula, data, n_jobs, gene_sets=gene_sets, rank_method=rank_method,
+                                     engine=engine, dtype=dtype)
+
+    if engine == 'matrix':
+        dtype = dtype or np.float64
+        gene_sets = CompiledGeneSets.from_gene_sets(gene_sets)
+        membership, n_common = gene_sets.align(data.columns)
+        used = np.flatnonzero(membership.getnnz(axis=0))
+
+        with stage('ssgsea_formula.rank', data):
+            member_ranks = rank_rows(data.values, rank_method, columns=used,
+                                     out=np.empty((len(data), len(used)), dtype=dtype))
+        scores = ssgsea_member_scores(member_ranks, membership[:, used], n_common, len(data.columns), dtype=dtype)
+        return pd.DataFrame(scores, index=data.index, columns=list(gene_sets.keys()))
+    elif engine == 'loop':
+        with stage('ssgsea_formula.rank', data):
+            ranks = data.T.rank(method=rank_method, na_option='bottom')
+        return pd.DataFrame({gs_name: ssgsea_score(ranks, gene_sets[gs_name].genes)
+                             for gs_name in list(gene_sets.keys())})
+    raise Exception(f'Unknown engine: {engine}')
+
+
+def iter_ssgsea_formula(data, gene_sets, rank_method='max', chunksize=1000, engine='matrix', n_jobs=None,
+                        dtype=None, result_cache=None):
+    """
+    Yield DataFrames with ssgsea scores for blocks of samples
+    Ranks are computed within each sample, so blocks are scored independently and
+    memory usage depends on the block size instead of the cohort size.
+    With n_jobs all blocks are scored by the same worker processes
+
+    :param data: str or Path to .tsv(.gz) file, pd.DataFrame or iterable of pd.DataFrame blocks;
+        samples in rows and genes in columns
+    :param gene_sets: dict, keys - processes, values - GeneSet
+    :param rank_method: str, 'min' or 'max'.
+    :param chunksize: int, number of samples in a block when reading a file or splitting a DataFrame
+    :param engine: str, see ssgsea_formula
+    :param n_jobs: int, number of processes to score each block, see ssgsea_formula
+    :param dtype: numpy float dtype, see ssgsea_formula
+    :param result_cache: lme.result_cache.ResultCache, see ssgsea_formula
+    :return: generator of pd.DataFrame, ssgsea scores, index - patients, columns - genesets
+    """
+    if isinstance(data, (str, Path)):
+        blocks = read_dataset_chunks(data, chunksize=chunksize, dtype=dtype)
+    elif isinstance(data, pd.DataFrame):
+        blocks = (data.iloc[i:i + chunksize] for i in range(0, len(data), chunksize))
+    else:
+        blocks = data
+
+    with SamplePool(ssgsea_formula, n_jobs, gene_sets=gene_sets, rank_method=rank_method, engine=engine,
+                    dtype=dtype) as pool:
+        for block in blocks:
+            yield ssgsea_formula(block, gene_sets, rank_method=rank_method, engine=engine, dtype=dtype,
+                                 result_cache=result_cache, pool=pool)
+
+
+def ssgsea_formula_chunked(data, gene_sets, rank_method='max', chunksize=1000, engine='matrix', n_jobs=None,
+                           dtype=None, result_cache=None):
+    """
+    Return DataFrame with ssgsea scores computed block by block, see iter_ssgsea_formula
 
-    ranks = data.T.rank(method=rank_method, na_option='bottom')
-
-    return pd.DataFrame({gs_name: ssgsea_score(ranks, gene_sets[gs_name].genes)
-                         for gs_name in list(gene_sets.keys())})
-
+    :return: pd.DataFrame, ssgsea scores, index - patients, columns - genesets
+    """
+    blocks = list(iter_ssgsea_formula(data, gene_sets, rank_method=rank_method, chunksize=chunksize,
+                                      engine=engine, n_jobs=n_jobs, dtype=dtype, result_cache=result_cache))
+    if not len(blocks):
+        return pd.DataFrame(columns=list(gene_sets.keys()), dtype=dtype or float)
+    return pd.concat(blocks)
+
+
+class MedianScaler(object):
+    def __init__(self, median=None, mad=None, mean=None, update_rate=None):
+        """
+        Median/MAD statistics of a reference cohort, applied to new samples as they arrive.
+        Samples are scaled independently of the batch they come in, a single sample can be scaled.
+        MAD is the mean absolute deviation from the mean, as in median_scale
+        :param median: pd.Series, index - features
+        :param mad: pd.Series, index - features
+        :param mean: pd.Series, index - features, used for running updates
+        :param update_rate: float, step of the running updates in update(), None - statistics are fixed
+        """
+        self.median = median
+        self.mad = mad
+        self.mean = mean
+        self.update_rate = update_rate
+
+    def fit(self, data):
+        """
+        :param data: pd.DataFrame, rows - samples, columns - features
+        :return: self
+        """
+        self.median = data.median()
+        self.mad = data.mad()
+        self.mean = data.mean()
+        return self
+
+    def transform(self, data, clip=None):
+        """
+        :param data: pd.DataFrame, rows - samples, columns - features
+        :param clip: float, clip scaled values to [-clip, clip]
+        :return: pd.DataFrame
+        """
+        c_data = (data - self.median) / self.mad
+        if clip is not None:
+            return c_data.clip(-clip, clip)
+        return c_data
+
+    def transform_array(self, x, columns, clip=None):
+        """
+        In place version of transform for a float numpy array
+        :param x: np.ndarray, samples x features
+        :param columns: features of x columns
+        :param clip: float
+        :return: np.ndarray, x
+        """
+        x -= self.median.reindex(columns).values
+        x /= self.mad.reindex(columns).values
+        if clip is not None:
+            np.clip(x, -clip, clip, out=x)
+        return x
+
+    def update(self, data):
+        """
+        Robust running update with new samples, one sample at a time: the median moves by update_rate * MAD towards
+        each value, mean and MAD are exponentially weighted. Does nothing if update_rate is None
+        :param data: pd.DataFrame, rows - samples, columns - features
+        :return: self
+        """
+        if self.update_rate is None:
+            return self
+
+        columns = self.median.index
+        median, mad, mean = self.median.values.copy(), self.mad.values.copy(), self.mean.values.copy()
+        for x in data[columns].values:
+            known = ~np.isnan(x)
+            median[known] += self.update_rate * mad[known] * np.sign(x[known] - median[known])
+            mad[known] += self.update_rate * (np.abs(x[known] - mean[known]) - mad[known])
+            mean[known] += self.update_rate * (x[known] - mean[known])
+
+        self.median = pd.Series(median, index=columns)
+        self.mad = pd.Series(mad, index=columns)
+        self.mean = pd.Series(mean, index=columns)
+        return self
+
+    def save(self, path):
+        """
+        Write statistics to a .tsv file, rows - features, columns - median, mad, mean
+        :param path: str or Path
+        """
+        pd.DataFrame({'median': self.median, 'mad': self.mad, 'mean': self.mean}).to_csv(path, sep='\t')
+
+    @classmethod
+    def load(cls, path, update_rate=None):
+        """
+        :param path: str or Path, file written with save
+        :param update_rate: float, see MedianScaler
+        :return: MedianScaler
+        """
+        stats = read_dataset(path)
+        return cls(stats['median'], stats['mad'], stats['mean'], update_rate=update_rate)
+
+
+@instrument()
+def median_scale(data, clip=None, scaler=None, dtype=None):
+    """
+    Scale features by median and MAD
+    :param data: pd.DataFrame, rows - samples, columns - features
+    :param clip: float, clip scaled values to [-clip, clip]
+    :param scaler: MedianScaler with reference statistics, None - use statistics of data
+    :param dtype: numpy float dtype of the result, None - keep dtype of data
+    :return: pd.DataFrame
+    """
+    data = as_dtype(data, dtype)
+    if scaler is not None:
+        return as_dtype(scaler.transform(data, clip=clip), dtype)
 
-def median_scale(data, clip=None):
-    c_data = (data - data.median()) / data.mad()
+    c_data = as_dtype((data - data.median()) / data.mad(), dtype)
     if clip is not None:
         return c_data.clip(-clip, clip)
     return c_data
 
 
-def read_dataset(file, sep='\t', header=0, index_col=0, comment=None):
-    return pd.read_csv(file, sep=sep, header=header, index_col=index_col,
-                       na_values=['Na', 'NA', 'NAN'], comment=comment)
+def median_scale_array(x, clip=None):
+    """
+    In place version of median_scale for a float numpy array, columns - features
+    :param x: np.ndarray, samples x features, or replicates x samples x features - replicates are scaled separately
+    :param clip: float, clip scaled values to [-clip, clip]
+    :return: np.ndarray, x
+    """
+    median = np.nanmedian(x, axis=-2, keepdims=True)
+    mad = np.nanmean(np.abs(x - np.nanmean(x, axis=-2, keepdims=True)), axis=-2, keepdims=True)
+    x -= median
+    x /= mad
+    if clip is not None:
+        np.clip(x, -clip, clip, out=x)
+    return x
+
+
+@instrument()
+def read_dataset(file, sep='\t', header=0, index_col=0, comment=None, columns=None, rows=None, cache=False, fmt=None,
+                 dtype=None):
+    """
+    Read a dataset. Format is detected by path: Parquet (.parquet, .pq), Feather (.feather, .ftr),
+    npy directory (see lme.io.write_npy_dataset), otherwise a text table parsed by pd.read_csv
+    :param file: str or Path
+    :param columns: list of columns to read, passed down to the reader where the format allows
+    :param rows: list of index labels to keep
+    :param cache: bool or str, for text tables - convert to a binary sidecar on the first read and read it later on.
+        True - sidecar next to the file, str - cache directory. The sidecar is invalidated by file mtime and hash
+    :param fmt: str, 'csv', 'parquet', 'feather' or 'npy' to override detection
+    :param dtype: numpy dtype of values (e.g. np.float32), text tables are converted by chunks
+    :return: pd.DataFrame
+    """
+    return read_table(file, sep=sep, header=header, index_col=index_col, comment=comment, columns=columns, rows=rows,
+                      cache=cache, fmt=fmt, dtype=dtype)
+
+
+def read_dataset_chunks(file, chunksize=1000, sep='\t', header=0, index_col=0, comment=None, dtype=None):
+    """
+    Read a dataset by blocks of rows, same parsing as read_dataset
+    :param file: str or Path, path to the file
+    :param chunksize: int, number of rows in a block
+    :param dtype: numpy dtype of values
+    :return: generator of pd.DataFrame
+    """
+    with pd.read_csv(file, sep=sep, header=header, index_col=index_col, na_values=NA_VALUES,
+                     comment=comment, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield as_dtype(chunk, dtype)
 
 
 def item_series(item, indexed=None):
@@ -93,16 +337,15 @@ def item_series(item, indexed=None):
 def to_common_samples(df_list=()):
     """
     Accepts a list of dataframes. Returns all dataframes with only intersecting indexes
+    Samples are in the order of the first dataframe, aligned frames are returned without copying.
+    The first of duplicated samples is taken
     :param df_list: list of pd.DataFrame
     :return: pd.DataFrame
     """
-    cs = set(df_list[0].index)
-    for i in range(1, len(df_list)):
-        cs = cs.intersection(df_list[i].index)
-
-    if len(cs) < 1:
+    common = common_index([df.index for df in df_list])
+    if len(common) < 1:
         warnings.warn('No common samples!')
-    return [df_list[i].loc[list(cs)] for i in range(len(df_list))]
+    return [take(df, index_positions(df.index, common)) for df in df_list]
 
 
 def query_genes_by_symbol(genes, verbose=False):
@@ -126,15 +369,41 @@ def query_genes_by_symbol(genes, verbose=False):
     return q
 
 
-def update_gene_names(genes_old, genes_cur, verbose=False):
+def query_gene_aliases(genes, verbose=False):
+    """
+    Return aliases of genes found by mygene (requires network access)
+    :param genes: list of gene names
+    :param verbose: bool
+    :return: dict {gene -> set of aliases}
+    """
+    qr = query_genes_by_symbol(list(genes), verbose=verbose)
+    if not hasattr(qr, 'alias'):
+        return {}
+    cg_ann = qr.alias.dropna()
+
+    aliases = {}
+    for cg in genes:
+        if cg in cg_ann.index:
+            if (isinstance(cg_ann.loc[cg], list)) | (isinstance(cg_ann.loc[cg], pd.core.series.Series)):
+                aliases[cg] = set(cg_ann[cg])
+            else:
+                aliases[cg] = set([cg_ann.loc[cg]])
+    return aliases
+
+
+@instrument()
+def update_gene_names(genes_old, genes_cur, verbose=False, alias_index=None, query_mygene=False):
     """
     Takes a set of gene names genes_old and matches it with genes_cur.
-    For all not found tries to match with known aliases using mygene or GeneStorage.
+    For all not found tries to match with known aliases from the local alias index (see lme.aliases)
+    and, if query_mygene=True, with aliases from mygene for genes missing in the index.
     All not matched are returned as is.
     Returns a dict with matching rule. No duplicates will be in output
     :param genes_old:
     :param genes_cur:
     :param verbose:
+    :param alias_index: GeneAliasIndex, default - load_alias_index()
+    :param query_mygene: bool, query mygene for genes which are not in alias_index. Requires network access
     :return:
     """
     c_genes = set(genes_cur)
@@ -156,30 +425,30 @@ def update_gene_names(genes_old, genes_cur, verbose=False):
             print('Trying to find new names for {} genes in {} known'.format(len(converting_genes),
                                                                              len(rest_genes)))
 
-        qr = query_genes_by_symbol(list(converting_genes), verbose=verbose)
-        if hasattr(qr, 'alias'):
-            cg_ann = qr.alias.dropna()
+        if alias_index is None:
+            alias_index = load_alias_index()
+
+        if alias_index is not None:
+            aliases = {cg: alias_index.aliases(cg) for cg in converting_genes if cg in alias_index}
         else:
-            cg_ann = pd.DataFrame()
+            aliases = {}
+            if not query_mygene:
+                warnings.warn('No gene alias table found, gene names are not converted. '
+                              'Provide alias_index or set query_mygene=True')
+
+        not_indexed = converting_genes.difference(aliases)
+        if query_mygene and len(not_indexed):
+            aliases.update(query_gene_aliases(list(not_indexed), verbose=verbose))
 
         for cg in converting_genes:
-            if cg in cg_ann.index:
-                if (isinstance(cg_ann.loc[cg], list)) | (isinstance(cg_ann.loc[cg], pd.core.series.Series)):
-                    al_set = set(cg_ann[cg])
-                else:
-                    al_set = set([cg_ann.loc[cg]])
-
-                hits = al_set.intersection(rest_genes)
-                if len(hits) == 1:
-                    match_rule[cg] = list(hits)[0]
-                    rest_genes.remove(match_rule[cg])
-                elif len(hits) > 1:
-                    warnings.warn('{} hits for gene {}'.format(len(hits), cg))
-                    match_rule[cg] = list(hits)[0]
-                    rest_genes.remove(match_rule[cg])
-                else:
-                    missing.add(cg)
-                    match_rule[cg] = cg
+            hits = set(aliases.get(cg, ())).intersection(rest_genes)
+            if len(hits) == 1:
+                match_rule[cg] = list(hits)[0]
+                rest_genes.remove(match_rule[cg])
+            elif len(hits) > 1:
+                warnings.warn('{} hits for gene {}'.format(len(hits), cg))
+                match_rule[cg] = list(hits)[0]
+                rest_genes.remove(match_rule[cg])
             else:
                 missing.add(cg)
                 match_rule[cg] = cg
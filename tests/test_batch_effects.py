@@ -0,0 +1,53 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from lme.batch_effects import batch_effects, batch_shift_statistics
+
+SIGNATURES = ['A', 'B', 'C']
+
+
+def synthetic_signatures(n_samples, shift=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(rng.normal(shift, 1, size=(n_samples, len(SIGNATURES))), columns=SIGNATURES,
+                        index=[f's{seed}_{i}' for i in range(n_samples)])
+
+
+def test_all_singleton_batches_are_not_assessable():
+    reference = synthetic_signatures(200)
+    signatures = synthetic_signatures(3, seed=1)
+    batches = pd.Series(['x', 'y', 'z'], index=signatures.index)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        gate = batch_effects(signatures, batches=batches, reference=reference)
+    assert any('can not be assessed' in str(w.message) for w in caught)
+    assert list(gate.index) == ['x', 'y', 'z']
+    assert not gate.assessable.any()
+    assert gate.passed.all()
+    assert (gate.shifted == 0).all()
+    assert gate.max_ks.isna().all()
+
+
+def test_single_sample_without_batches():
+    reference = synthetic_signatures(200)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        gate = batch_effects(synthetic_signatures(1, seed=1), reference=reference, scale=False)
+    assert len(gate) == 1
+    assert not gate.assessable.iloc[0] and gate.passed.iloc[0]
+    assert gate.samples.iloc[0] == 1
+
+
+def test_shifted_batch_next_to_singleton():
+    reference = synthetic_signatures(300)
+    signatures = pd.concat([synthetic_signatures(100, shift=2.0, seed=1), synthetic_signatures(1, seed=2)])
+    batches = pd.Series(['shifted'] * 100 + ['single'], index=signatures.index)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        statistics = batch_shift_statistics(signatures, batches=batches, reference=reference, scale=False)
+        gate = batch_effects(signatures, batches=batches, reference=reference, scale=False)
+    assert statistics.loc['single'].ks.isna().all()
+    assert gate.loc['shifted', 'assessable'] and not gate.loc['shifted', 'passed']
+    assert gate.loc['shifted', 'shifted'] == len(SIGNATURES)
+    assert gate.loc['single', 'passed'] and not gate.loc['single', 'assessable']
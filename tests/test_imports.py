@@ -0,0 +1,29 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+HEAVY_MODULES = ['sklearn', 'matplotlib', 'seaborn', 'umap', 'scipy.stats', 'joblib']
+# Seconds of the imports, about 0.5 s; numpy, pandas and scipy take most of it
+IMPORT_BUDGET = 1
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import lme
+from lme import ssgsea_formula, run_progeny
+seconds = time.perf_counter() - start
+import pandas as pd
+from lme.gene_sets import GeneSet
+ssgsea_formula(pd.DataFrame([[1.0, 2.0], [3.0, 1.0]], columns=['A', 'B']), {'gs': GeneSet('gs', '', ['A'])})
+print(json.dumps({'seconds': seconds, 'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def test_import_and_scoring_are_lightweight():
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT % HEAVY_MODULES], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    assert result['loaded'] == []
+    assert result['seconds'] < IMPORT_BUDGET
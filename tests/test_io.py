@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from lme.io import read_table, select, write_dataset
+
+
+def dataset(index_name):
+    rng = np.random.default_rng(0)
+    index = pd.Index([f's{i}' for i in range(30)], name=index_name)
+    return pd.DataFrame(rng.normal(size=(30, 12)), index=index, columns=[f'G{i}' for i in range(12)])
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather', 'csv'])
+@pytest.mark.parametrize('index_name', [None, 'sample'])
+def test_selected_columns_and_rows(tmp_path, fmt, index_name):
+    df = dataset(index_name)
+    path = tmp_path / ('data.tsv' if fmt == 'csv' else f'data.{fmt}')
+    write_dataset(df, path, fmt=fmt)
+    columns, rows = ['G7', 'G2', 'G3'], ['s20', 's3', 'missing', 's11']
+    result = read_table(path, columns=columns, rows=rows, fmt=fmt)
+    expected = select(df, columns, rows)
+    pd.testing.assert_frame_equal(result, expected, check_names=False, check_freq=False)
+    pd.testing.assert_frame_equal(read_table(path, fmt=fmt), df, check_names=False)
+
+
+def test_parquet_range_index(tmp_path):
+    df = dataset(None).reset_index(drop=True)
+    path = tmp_path / 'data.parquet'
+    write_dataset(df, path)
+    pd.testing.assert_frame_equal(read_table(path, rows=[3, 5], columns=['G1']), df.loc[[3, 5], ['G1']])
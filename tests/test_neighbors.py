@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from lme.neighbors import IVFNeighbors, NeighborsBackend, squared_distances
+
+
+@pytest.fixture(scope='module')
+def reference():
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(300, 8)), rng.choice(['A', 'B', 'C'], 300)
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        NeighborsBackend()
+
+
+def test_exhaustive_probe_is_exact(reference):
+    X, y = reference
+    queries = np.random.default_rng(1).normal(size=(20, 8))
+    model = IVFNeighbors(n_neighbors=5, n_lists=10, n_probe=10).fit(X, y)
+    distances, indices = model.kneighbors(queries)
+    expected = np.argsort(squared_distances(queries, X), axis=1, kind='stable')[:, :5]
+    np.testing.assert_array_equal(indices, expected)
+    np.testing.assert_allclose(distances, np.linalg.norm(queries[:, np.newaxis] - X[expected], axis=2))
+
+
+def test_too_many_neighbors(reference):
+    X, y = reference
+    with pytest.raises(Exception, match='decrease n_neighbors'):
+        IVFNeighbors(n_neighbors=301).fit(X, y)
+    model = IVFNeighbors(n_neighbors=5).fit(X, y)
+    with pytest.raises(Exception, match='Can not find 400 neighbors'):
+        model.kneighbors(X[:2], n_neighbors=400)
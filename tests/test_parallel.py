@@ -0,0 +1,49 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from lme.gene_sets import GeneSet
+from lme.parallel import SamplePool, map_sample_partitions
+from lme.pathway_scoring import PROGENY_COEFFICIENTS, run_progeny
+from lme.utils import read_dataset, ssgsea_formula, ssgsea_formula_chunked
+
+
+def worker_sums(block, offset=0):
+    return pd.DataFrame({'pid': os.getpid(), 'total': block.values.sum(axis=1) + offset}, index=block.index)
+
+
+def expression(genes, n_samples=11):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(np.log2(1 + rng.gamma(0.5, 20, (n_samples, len(genes)))), columns=genes,
+                        index=[f's{i}' for i in range(n_samples)])
+
+
+def test_pool_is_reused_across_maps():
+    blocks = [pd.DataFrame(np.arange(20.0).reshape(10, 2) + i, index=[f'{i}_{j}' for j in range(10)])
+              for i in range(3)]
+    with SamplePool(worker_sums, 2, offset=1) as pool:
+        results = [pool.map(block) for block in blocks]
+    pids = set(pd.concat(results).pid)
+    assert len(pids) <= 2 and os.getpid() not in pids
+    for block, result in zip(blocks, results):
+        np.testing.assert_array_equal(result.total, block.values.sum(axis=1) + 1)
+    pd.testing.assert_series_equal(map_sample_partitions(worker_sums, blocks[0], 2).total,
+                                   worker_sums(blocks[0]).total)
+
+
+def test_chunked_ssgsea_in_processes():
+    data = expression([f'G{i}' for i in range(40)])
+    gene_sets = {'first': GeneSet('first', '', [f'G{i}' for i in range(10)]),
+                 'second': GeneSet('second', '', ['G3', 'G17', 'G30', 'MISSING'])}
+    expected = ssgsea_formula(data, gene_sets)
+    pd.testing.assert_frame_equal(ssgsea_formula_chunked(data, gene_sets, chunksize=4, n_jobs=2), expected)
+
+
+def test_progeny_in_processes():
+    genes = list(read_dataset(PROGENY_COEFFICIENTS, index_col=None).hugo_symbol.unique())
+    exp = expression(['OTHER1'] + genes[::2] + ['OTHER2'])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        pd.testing.assert_frame_equal(run_progeny(exp, n_jobs=2), run_progeny(exp))
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from lme.ranking import rank_rows
+
+
+def ranking_input(dtype=np.float64):
+    rng = np.random.default_rng(0)
+    # Few distinct values for many ties
+    x = rng.integers(0, 8, size=(23, 40)).astype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        x[rng.random(x.shape) < 0.1] = np.nan
+        x[rng.random(x.shape) < 0.05] = np.inf
+        x[rng.random(x.shape) < 0.05] = -np.inf
+        x[3] = np.nan
+        x[4] = 1.5
+    return x
+
+
+def pandas_ranks(x, method):
+    return pd.DataFrame(x).rank(axis=1, method=method, na_option='bottom').values
+
+
+@pytest.mark.parametrize('method', ['min', 'max'])
+@pytest.mark.parametrize('block_size', [None, 1, 5, 23, 100])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.int64])
+def test_rank_rows_matches_pandas(method, block_size, dtype):
+    x = ranking_input(dtype)
+    np.testing.assert_array_equal(rank_rows(x, method, block_size=block_size), pandas_ranks(x, method))
+
+
+@pytest.mark.parametrize('method', ['min', 'max'])
+@pytest.mark.parametrize('block_size', [None, 1, 5, 23, 100])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.int64])
+def test_rank_selected_columns_matches_pandas(method, block_size, dtype):
+    x = ranking_input(dtype)
+    columns = np.array([0, 3, 7, 7, 39, 12])
+    np.testing.assert_array_equal(rank_rows(x, method, columns=columns, block_size=block_size),
+                                  pandas_ranks(x, method)[:, columns])
+
+
+def test_rank_rows_out():
+    x = ranking_input()
+    out = np.empty((len(x), 2), dtype=np.float32)
+    assert rank_rows(x, 'max', columns=[1, 2], out=out) is out
+    np.testing.assert_array_equal(out, pandas_ranks(x, 'max')[:, [1, 2]])
+    with pytest.raises(Exception):
+        rank_rows(x, 'max', out=out)
+    with pytest.raises(Exception):
+        rank_rows(x, 'average')
@@ -0,0 +1,92 @@
+import asyncio
+import urllib.error
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lme.pathway_scoring import PROGENY_COEFFICIENTS
+from lme.pipeline import GENE_SIGNATURES, LMEPipeline, main
+from lme.server import LMEServer, classify_remote
+from lme.utils import read_dataset, read_gene_sets
+
+
+@pytest.fixture(scope='module')
+def pipeline():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return LMEPipeline()
+
+
+def synthetic_expression(n_samples, seed):
+    genes = [gene for gene_set in read_gene_sets(GENE_SIGNATURES).values() for gene in gene_set.genes]
+    genes = list(dict.fromkeys(genes + list(read_dataset(PROGENY_COEFFICIENTS, index_col=None).hugo_symbol)))
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(np.log2(1 + rng.gamma(0.5, 20, (n_samples, len(genes)))), columns=genes,
+                        index=[f'r{seed}_{i}' for i in range(n_samples)])
+
+
+def send(server, expression):
+    try:
+        return 200, classify_remote(expression, f'http://127.0.0.1:{server.port}')
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+def serve_requests(pipeline, expressions, max_delay=0.5):
+    async def run():
+        server = LMEServer(pipeline, max_delay=max_delay)
+        await server.start(port=0)
+        loop = asyncio.get_running_loop()
+        try:
+            responses = await asyncio.gather(*[loop.run_in_executor(None, send, server, expression)
+                                               for expression in expressions])
+        finally:
+            await server.stop()
+        return responses, server.handle_stats()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return asyncio.run(run())
+
+
+def test_concurrent_requests_are_micro_batched(pipeline):
+    expressions = [synthetic_expression(6, seed) for seed in range(3)]
+    responses, stats = serve_requests(pipeline, expressions)
+
+    assert [status for status, _ in responses] == [200, 200, 200]
+    assert stats['batches'] < 3
+    assert max(response['batch_size'] for _, response in responses) > 6
+    for expression, (_, response) in zip(expressions, responses):
+        assert list(response['labels']) == list(expression.index)
+        expected = pipeline.run(expression)[0]
+        assert response['labels'] == expected.to_dict()
+
+
+def test_bad_request_fails_alone(pipeline):
+    good = [synthetic_expression(6, seed) for seed in range(2)]
+    # Constant expressions can not be median scaled
+    bad = pd.DataFrame(1.0, index=['c0', 'c1', 'c2'], columns=good[0].columns)
+    responses, stats = serve_requests(pipeline, [good[0], bad, good[1]])
+
+    assert [status for status, _ in responses] == [200, 400, 200]
+    assert 'not finite' in responses[1][1]
+    assert responses[0][1]['batch_size'] == 15
+    assert stats['errors'] == 1
+
+
+def test_single_sample_without_scaler_is_rejected(pipeline):
+    responses, stats = serve_requests(pipeline, [synthetic_expression(1, 0)], max_delay=0)
+    assert responses[0][0] == 400
+    assert 'at least 2 samples' in responses[0][1]
+    assert stats['batches'] == 0
+
+
+def test_cli_single_sample_requires_scaler(tmp_path):
+    path = tmp_path / 'single.tsv'
+    synthetic_expression(1, 0).to_csv(path, sep='\t')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with pytest.raises(Exception, match='--scaler'):
+            main([str(path), '-o', str(tmp_path / 'out')])
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from lme.gene_sets import CompiledGeneSets, GeneSet
+from lme.utils import ssgsea_formula
+
+
+@pytest.fixture(scope='module')
+def data():
+    rng = np.random.default_rng(0)
+    genes = [f'G{i}' for i in range(60)]
+    values = np.round(rng.gamma(0.5, 20, (15, len(genes))), 1)
+    values[rng.random(values.shape) < 0.1] = np.nan
+    data = pd.DataFrame(values, index=[f's{i}' for i in range(15)], columns=genes)
+    # Duplicated gene column
+    return pd.concat([data, data[['G5']] * 2], axis=1)
+
+
+@pytest.fixture(scope='module')
+def gene_sets():
+    return {
+        'first': GeneSet('first', '', [f'G{i}' for i in range(10)]),
+        'duplicated': GeneSet('duplicated', '', ['G5', 'G20', 'G21', 'MISSING']),
+        'sparse': GeneSet('sparse', '', ['G59', 'G0', 'G33']),
+        'no_overlap': GeneSet('no_overlap', '', ['X1', 'X2']),
+    }
+
+
+@pytest.mark.parametrize('rank_method', ['min', 'max'])
+def test_matrix_engine_matches_loop(data, gene_sets, rank_method):
+    loop = ssgsea_formula(data, gene_sets, rank_method=rank_method, engine='loop')
+    matrix = ssgsea_formula(data, gene_sets, rank_method=rank_method, engine='matrix')
+    assert list(matrix.columns) == list(loop.columns)
+    assert list(matrix.index) == list(loop.index)
+    np.testing.assert_allclose(matrix.values, loop.values.astype(float), rtol=0, atol=1e-9)
+    assert (matrix['no_overlap'] == 0).all()
+
+
+def test_compiled_gene_sets_match_dict(data, gene_sets):
+    compiled = CompiledGeneSets.from_gene_sets(gene_sets)
+    pd.testing.assert_frame_equal(ssgsea_formula(data, compiled), ssgsea_formula(data, gene_sets))
@@ -0,0 +1,14 @@
+import warnings
+
+import numpy as np
+
+from lme.validation import SCORE_TOLERANCE, synthetic_expression, validate_scores
+
+
+def test_float32_scores_within_tolerance():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        report = validate_scores(np.float32, synthetic_expression(n_samples=50, n_other_genes=2000))
+    assert [row['stage'] for row in report] == ['ssgsea', 'progeny']
+    for row in report:
+        assert 0 < row['max_relative_score_difference'] < SCORE_TOLERANCE